@@ -15,7 +15,7 @@ FUNCTIONS:
     calcBrightTemp
 
 SYNTAX:
-    python full-script-path/BrightTempCalc.py [full path of metadata file ending in '/', metadata filename, true/false, band]
+    python full-script-path/BrightTempCalc.py [full path of metadata file ending in '/', metadata filename, true/false, band] [--tile MB] [--profile name]
     files will be saved in metadata_file_path (so in imagery folder) with same naming convention as original band file names + "_bt"
     true/false indicates whether or not to keep the intermediary radiance files\
     
@@ -80,59 +80,83 @@ def acquireMetadata(metadata, band):
 
 
 #calculatethe radiance from metadata on band. For landsat 8
-def LS8_calcRadiance (rad_mult, rad_add, path, QCAL, band):
+    #tileMB limits the size of the windows read/written at a time (None processes the whole band at once)
+def LS8_calcRadiance (rad_mult, rad_add, path, QCAL, band, tileMB=None):
 	
     rad_mult = float(rad_mult)
     rad_add = float(rad_add)
     inraster_open = gdal.Open(path + QCAL)
-    inraster_array = inraster_open.GetRasterBand(1).ReadAsArray() 
+    inband = inraster_open.GetRasterBand(1)
     radiance = path + 'RadianceB'+str(band)+'.tif'
-    inraster_open = None
+    outraster_open = raster.create_rasterfile(path+QCAL, radiance, gdal.GDT_Float32, -9999)
+    outband = outraster_open.GetRasterBand(1)
     
-    outraster_array = ((rad_mult * inraster_array) + rad_add)
-    outraster_array[(inraster_array==0)] = -9999
-    #code improvement: is there a better way than the above line to take whatever the nodata value is and use that, vs assuming it's 0?
-    radiance = raster.rasterfile(path+QCAL, radiance, outraster_array, gdal.GDT_Float32, -9999)
+    for xoff, yoff, xsize, ysize in raster.block_windows(inband, tileMB):
+        inraster_array = inband.ReadAsArray(xoff, yoff, xsize, ysize)
+        #nodata is taken from the band (nodata value or mask band), falling back to DN 0
+        is_nodata = raster.nodata_mask(inband, inraster_array, xoff, yoff, 0)
+        outraster_array = raster.scale_array(inraster_array, rad_mult, rad_add)
+        raster.set_nodata(outraster_array, is_nodata, -9999)
+        outband.WriteArray(outraster_array, xoff, yoff)
     
+    inraster_open = None
+    outraster_open = raster.close_rasterfile(outraster_open)
     return radiance
 
 
 #calculates brightness temperature for LS5,7,8, in Kelvin
-def calcBrightTemp (K1, K2, radiance, path, band):
+def calcBrightTemp (K1, K2, radiance, path, band, tileMB=None):
 
     K1 = float(K1)
     K2 = float(K2)
     inraster_open = gdal.Open(radiance)
-    inraster_array = inraster_open.GetRasterBand(1).ReadAsArray() 
+    inband = inraster_open.GetRasterBand(1)
     filename_pref = os.path.basename(os.path.dirname(path))
     BT = path+filename_pref+'_B'+str(band)+'_bt.tif'
 #    BT = path+path[-22:-1]+'_B'+str(band)+'_bt.tif'
-    inraster_open = None
+    outraster_open = raster.create_rasterfile(radiance, BT, gdal.GDT_Float32, -9999)
+    outband = outraster_open.GetRasterBand(1)
     
 #    if not inraster_array.all():
 #        print 'inraster_array empty'
 #        sys.exit
     
-    is_zero = (inraster_array<=0)
-    inraster_array[is_zero] = 1   
-    
-    outraster_array = (K2 / (np.log((K1/inraster_array) + 1)))
-    outraster_array[is_zero] = -9999
-    outraster_array[(inraster_array==-9999)] = -9999
-    #code improvement: is there a better way than the above line to take whatever the nodata value is and use that, vs assuming it's -9999?
-    BrightTemp = raster.rasterfile(radiance, BT, outraster_array, gdal.GDT_Float32, -9999)
+    for xoff, yoff, xsize, ysize in raster.block_windows(inband, tileMB):
+        inraster_array = inband.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.float32, copy=False)
+        #nodata pixels of the radiance raster plus radiances the log can't take
+        is_zero = (inraster_array<=0)
+        is_nodata = raster.nodata_mask(inband, inraster_array, xoff, yoff, -9999)
+        if is_nodata is not None:
+            is_zero |= is_nodata
+        inraster_array[is_zero] = 1   
+        
+        #K2 / ln((K1/radiance) + 1), computed in place in float32
+        outraster_array = inraster_array
+        np.divide(np.float32(K1), outraster_array, out=outraster_array)
+        outraster_array += 1
+        np.log(outraster_array, out=outraster_array)
+        np.divide(np.float32(K2), outraster_array, out=outraster_array)
+        raster.set_nodata(outraster_array, is_zero, -9999)
+        outband.WriteArray(outraster_array, xoff, yoff)
     
-    return BrightTemp
+    inraster_open = None
+    outraster_open = raster.close_rasterfile(outraster_open)
+    return BT
     
 
 #////////////////////////////////////MAIN LOOP///////////////////////////////////////
 #Parameters from input
     #input format is python full-script-path/BrightTempCalc.py [full path of metadata file ending in '/', metadata filename, true/false, band]
 
-metadataPath = sys.argv[1]
-metadataName = sys.argv[2]
-keepRad = str(sys.argv[3])
-band = str(sys.argv[4])
+    #optional: --tile MB streams the band in block-aligned windows of at most MB megabytes
+args, options = toa.splitOptions(sys.argv)
+metadataPath = args[1]
+metadataName = args[2]
+keepRad = str(args[3])
+band = str(args[4])
+tileMB = float(options['tile']) if 'tile' in options else None
+if 'profile' in options:
+    raster.set_output_profile(options['profile'])
 
 metadataFile = open(metadataPath+metadataName)
 metadata = toa.readMetadata(metadataFile)
@@ -162,10 +186,10 @@ if metadata["SPACECRAFT_ID"] == 'LANDSAT_7':
     
     print 'bandfile is ', metadata[BANDFILE] #
     try:
-        radianceRaster = toa.calcRadiance(metadata[LMAX], metadata[LMIN], metadata[QCALMAX], metadata[QCALMIN], metadataPath, metadata[BANDFILE], band)
+        radianceRaster = toa.calcRadiance(metadata[LMAX], metadata[LMIN], metadata[QCALMAX], metadata[QCALMIN], metadataPath, metadata[BANDFILE], band, tileMB)
         #print 'radianceRaster successfully executed'    
                 
-        brightnessRaster = calcBrightTemp (K1, K2, radianceRaster, metadataPath, band)
+        brightnessRaster = calcBrightTemp (K1, K2, radianceRaster, metadataPath, band, tileMB)
         #print 'brightnessRaster successfully executed'
 
         #simply deletes the unneeded radianceRaster
@@ -191,10 +215,10 @@ elif metadata["SPACECRAFT_ID"] == 'LANDSAT_8':
     print 'bandfile is ', metadata[BANDFILE] #
     
     try:
-        radianceRaster = LS8_calcRadiance (metadata[RADIANCE_MULT], metadata[RADIANCE_ADD], metadataPath, metadata[BANDFILE], band)
+        radianceRaster = LS8_calcRadiance (metadata[RADIANCE_MULT], metadata[RADIANCE_ADD], metadataPath, metadata[BANDFILE], band, tileMB)
         #print 'radianceRaster successfully executed' #
         
-        brightnessRaster = calcBrightTemp (metadata[K1], metadata[K2], radianceRaster, metadataPath, band)
+        brightnessRaster = calcBrightTemp (metadata[K1], metadata[K2], radianceRaster, metadataPath, band, tileMB)
         #print 'brightness temperature successfully executed'
 
         #simply deletes the unneeded radianceRaster
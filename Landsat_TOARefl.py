@@ -14,13 +14,19 @@ DESCRIPTION: calculate top of atmosphere reflectance (including the solar correc
 for Landsat imagery. For Landsat <7, this requires also calculating radiance.
 
 SYNTAX:
-python full_path_to_script/Landsat_TOARefl.py [full path of metadata file ending in '/', metadata filename, "SITType", true/false, bands]
+python full_path_to_script/Landsat_TOARefl.py [full path of metadata file ending in '/', metadata filename, "SITType", true/false, bands] [--tile MB] [--workers N] [--profile name] [--stack band/pixel [--npy true]]
     files will be saved in metadata_file_path (so in imagery folder) with same naming convention as original band file names + "_refl"
-    true/false indicates whether or not to keep the intermediary radiance files
+    true/false indicates whether or not to keep the intermediary radiance files (radiance is otherwise never written to disk)
     see getESUN function for SITTypes (which vary by Landsat and aren't needed for LS8); I've been using 'ETM+ Thuillier'
+    --tile MB (optional) processes each band in block-aligned windows of at most MB megabytes instead of reading the whole band
+    --workers N (optional) converts up to N bands in parallel worker processes
+    --profile name (optional) sets the layout/compression of the output files (see raster.OUTPUT_PROFILES, e.g. deflate or cog)
+    --stack band/pixel (optional) writes all bands into one band- or pixel-interleaved file (..._B<bands>_refl_stack.tif) instead of
+        one _refl.tif per band (bands must have the same size; --workers is ignored); --npy true also writes a .npy memmap copy
 """
 
 import sys, os, math, time
+import multiprocessing
 from osgeo import gdal
 import raster as raster
 
@@ -66,18 +72,22 @@ def acquireMetadata(metadata, band):
 
 
 #Calculate the radiance from metadata on band. For Landsats 7 and earlier
-def calcRadiance (LMAX, LMIN, QCALMAX, QCALMIN, path, QCAL, band):
+    #tileMB limits the size of the windows read/written at a time (None processes the whole band at once)
+def calcRadiance (LMAX, LMIN, QCALMAX, QCALMIN, path, QCAL, band, tileMB=None):
     
     LMAX = float(LMAX)
     LMIN = float(LMIN)
     QCALMAX = float(QCALMAX)
     QCALMIN = float(QCALMIN)
     offset = (LMAX - LMIN)/(QCALMAX-QCALMIN)
+    #(offset * (QCAL-QCALMIN)) + LMIN, folded into a single gain and bias
+    bias = LMIN - (offset * QCALMIN)
     inraster_open = gdal.Open(path+QCAL)
-    inraster_array = inraster_open.GetRasterBand(1).ReadAsArray() 
+    inband = inraster_open.GetRasterBand(1)
     radiance = path + 'RadianceB'+str(band)+'.tif'
 #    radiance = path+path[-22:-1]+'_B'+str(band)+'_radiance.tif'
-    inraster_open = None
+    outraster_open = raster.create_rasterfile(path+QCAL, radiance, gdal.GDT_Float32, -9999)
+    outband = outraster_open.GetRasterBand(1)
 
     '''
     print 'Band'+str(band)
@@ -88,16 +98,21 @@ def calcRadiance (LMAX, LMIN, QCALMAX, QCALMIN, path, QCAL, band):
     print 'offset = '+str(offset)
     '''    
     
-    outraster_array = (offset * (inraster_array-QCALMIN)) + LMIN
-    outraster_array[(inraster_array==0)] = -9999
-    #code improvement: is there a better way than the above line to take whatever the nodata value is and use that, vs assuming it's 0?
-    radiance = raster.rasterfile(path+QCAL, radiance, outraster_array, gdal.GDT_Float32, -9999)
-    
+    for xoff, yoff, xsize, ysize in raster.block_windows(inband, tileMB):
+        inraster_array = inband.ReadAsArray(xoff, yoff, xsize, ysize)
+        #nodata is taken from the band (nodata value or mask band), falling back to DN 0 for Level 1 files that don't set one
+        is_nodata = raster.nodata_mask(inband, inraster_array, xoff, yoff, 0)
+        outraster_array = raster.scale_array(inraster_array, offset, bias)
+        raster.set_nodata(outraster_array, is_nodata, -9999)
+        outband.WriteArray(outraster_array, xoff, yoff)
+
+    inraster_open = None
+    outraster_open = raster.close_rasterfile(outraster_open)
     return radiance
 
 
 #calculate reflectance from radiance and other values; for Landsat7 and earlier
-def calcReflectance(solarDist, ESUN, solarElevation, radianceRaster, path, scaleFactor):
+def calcReflectance(solarDist, ESUN, solarElevation, radianceRaster, path, scaleFactor, band, tileMB=None):
     
 #    print 'entering reflectance fn'
     #Value for solar zenith is 90 degrees minus solar elevation (angle from horizon to the center of the sun)
@@ -107,54 +122,129 @@ def calcReflectance(solarDist, ESUN, solarElevation, radianceRaster, path, scale
     solarZenith = ((90.0 - (float(solarElevation)))*math.pi)/180 #Converted from deg to rad (python takes angles in rad)
     solarDist = float(solarDist)
     ESUN = float(ESUN)
+    #all the scalar terms of the reflectance equation, computed once
+    gain = (math.pi * math.pow(solarDist, 2)) / (ESUN * math.cos(solarZenith)) * scaleFactor
 #    print radianceRaster
     radiance_open = gdal.Open(radianceRaster)
-    radiance_array = radiance_open.GetRasterBand(1).ReadAsArray() 
+    inband = radiance_open.GetRasterBand(1)
 #    reflectance = path + 'ReflecB'+str(band)+'.tif'
     filename_pref = os.path.basename(os.path.dirname(path))
     reflectance = path+filename_pref+'_B'+str(band)+'_refl.tif'
-    radiance_open = None
+    outraster_open = raster.create_rasterfile(radianceRaster, reflectance, gdal.GDT_Float32, -9999)
+    outband = outraster_open.GetRasterBand(1)
     
 #     print 'Band'+str(band)
 #     print 'solarDist = '+str(solarDist)
 #     #print 'solarDistSquared ='+str(math.pow(solarDist, 2))
 #     print 'ESUN = '+str(ESUN)
 #     print 'solarZenith = '+str(solarZenith)
-    outraster_array = (math.pi * radiance_array * math.pow(solarDist, 2)) / (ESUN * math.cos(solarZenith)) * scaleFactor
-    outraster_array[(radiance_array==-9999)] = -9999
-    #code improvement: is there a better way than the above line to take whatever the nodata value is and use that, vs assuming it's -9999?
+    for xoff, yoff, xsize, ysize in raster.block_windows(inband, tileMB):
+        radiance_array = inband.ReadAsArray(xoff, yoff, xsize, ysize)
+        is_nodata = raster.nodata_mask(inband, radiance_array, xoff, yoff, -9999)
+        outraster_array = raster.scale_array(radiance_array, gain, 0, radiance_array)
+        raster.set_nodata(outraster_array, is_nodata, -9999)
+        outband.WriteArray(outraster_array, xoff, yoff)
 
-    reflectance = raster.rasterfile(radianceRaster, reflectance, outraster_array, gdal.GDT_Float32, -9999)
+    radiance_open = None
+    outraster_open = raster.close_rasterfile(outraster_open)
     return reflectance
-    
-    
-def LS8_calcReflectance(refl_mult, refl_add, solarElevation, path, QCAL):
+
+
+#calculate reflectance directly from the QCAL DN values in one pass (fuses calcRadiance and calcReflectance); for Landsat7 and earlier
+    #the intermediary radiance raster is only written to disk if keepRad is 'true'
+    #outBand (optional) is a band of an open raster (e.g. a multi-band stack) to write into instead of a new _refl.tif file (returns None then)
+def calcReflectanceFromDN(LMAX, LMIN, QCALMAX, QCALMIN, solarDist, ESUN, solarElevation, path, QCAL, band, scaleFactor, keepRad, tileMB=None, outBand=None):
+
+    LMAX = float(LMAX)
+    LMIN = float(LMIN)
+    QCALMAX = float(QCALMAX)
+    QCALMIN = float(QCALMIN)
+    offset = (LMAX - LMIN)/(QCALMAX-QCALMIN)
+    solarZenith = ((90.0 - (float(solarElevation)))*math.pi)/180 #Converted from deg to rad
+    solarDist = float(solarDist)
+    ESUN = float(ESUN)
+    #radiance = (rad_gain * QCAL) + rad_bias and reflectance = refl_gain * radiance, so the reflectance
+        #can be computed straight from QCAL with the constants folded: (refl_gain*rad_gain * QCAL) + refl_gain*rad_bias
+    rad_gain = offset
+    rad_bias = LMIN - (offset * QCALMIN)
+    refl_gain = (math.pi * math.pow(solarDist, 2)) / (ESUN * math.cos(solarZenith)) * scaleFactor
+    inraster_open = gdal.Open(path+QCAL)
+    inband = inraster_open.GetRasterBand(1)
+    filename_pref = os.path.basename(os.path.dirname(path))
+    reflectance = path+filename_pref+'_B'+str(band)+'_refl.tif'
+    outraster_open, outband, reflectance = reflectanceOutput(path+QCAL, reflectance, outBand)
+    radiance_open = None
+    if keepRad == 'true':
+        radiance_open = raster.create_rasterfile(path+QCAL, path + 'RadianceB'+str(band)+'.tif', gdal.GDT_Float32, -9999)
+        radband = radiance_open.GetRasterBand(1)
+
+    for xoff, yoff, xsize, ysize in raster.block_windows(inband, tileMB):
+        inraster_array = inband.ReadAsArray(xoff, yoff, xsize, ysize)
+        #the nodata mask is computed once per window and reused for both the radiance and the reflectance
+        is_nodata = raster.nodata_mask(inband, inraster_array, xoff, yoff, 0)
+        if radiance_open is not None:
+            radiance_array = raster.scale_array(inraster_array, rad_gain, rad_bias)
+            raster.set_nodata(radiance_array, is_nodata, -9999)
+            radband.WriteArray(radiance_array, xoff, yoff)
+            #the radiance buffer is reused for the reflectance
+            outraster_array = raster.scale_array(radiance_array, refl_gain, 0, radiance_array)
+        else:
+            outraster_array = raster.scale_array(inraster_array, refl_gain * rad_gain, refl_gain * rad_bias)
+        raster.set_nodata(outraster_array, is_nodata, -9999)
+        outband.WriteArray(outraster_array, xoff, yoff)
+
+    inraster_open = None
+    if radiance_open is not None:
+        radiance_open = raster.close_rasterfile(radiance_open)
+    if outraster_open is not None:
+        outraster_open = raster.close_rasterfile(outraster_open)
+    return reflectance
+
+
+#outBand (optional) is a band of an open raster (e.g. a multi-band stack) to write into instead of a new _refl.tif file (returns None then)
+def LS8_calcReflectance(refl_mult, refl_add, solarElevation, path, QCAL, band, tileMB=None, outBand=None):
     
 #    print 'LS8_calcReflectance entered' #
     solarElevationRad = (float(solarElevation)*math.pi)/180 #Converted from degr to rad (python takes angles in rad)
     refl_mult = float(refl_mult)
     refl_add = float(refl_add)
+    #((refl_mult * QCAL) + refl_add) / sin(solarElevation), folded into a single gain and bias
+    gain = refl_mult / math.sin(solarElevationRad)
+    bias = refl_add / math.sin(solarElevationRad)
     inraster_open = gdal.Open(path+QCAL)
-    inraster_array = inraster_open.GetRasterBand(1).ReadAsArray() 
+    inband = inraster_open.GetRasterBand(1)
     filename_pref = os.path.basename(os.path.dirname(path))
     reflectance = path+filename_pref+'_B'+str(band)+'_refl.tif'
 #    reflectance = path+path[-22:-1]+'_B'+str(band)+'_refl.tif'
-    inraster_open = None
+    outraster_open, outband, reflectance = reflectanceOutput(path+QCAL, reflectance, outBand)
     
     # print 'Band'+str(band)
 #     print 'solarElevation (radians) = '+str(solarElevationRad)
 #     print 'refl_mult = ' + str(refl_mult)
 #     print 'refl_add = ' + str(refl_add)
 
-    outraster_array = ((refl_mult * inraster_array) + refl_add) / (math.sin(solarElevationRad))
-    outraster_array[(inraster_array==0)] = -9999
-    #code improvement: is there a better way than the above line to take whatever the nodata value is and use that, vs assuming it's -9999?
+    for xoff, yoff, xsize, ysize in raster.block_windows(inband, tileMB):
+        inraster_array = inband.ReadAsArray(xoff, yoff, xsize, ysize)
+        is_nodata = raster.nodata_mask(inband, inraster_array, xoff, yoff, 0)
+        outraster_array = raster.scale_array(inraster_array, gain, bias)
+        raster.set_nodata(outraster_array, is_nodata, -9999)
+        outband.WriteArray(outraster_array, xoff, yoff)
 
-    reflectance = raster.rasterfile(path+QCAL, reflectance, outraster_array, gdal.GDT_Float32, -9999)
-    
+    inraster_open = None
+    if outraster_open is not None:
+        outraster_open = raster.close_rasterfile(outraster_open)
     return reflectance
 
 
+#returns (open dataset, band, filename) to write a reflectance into: a new Float32 file on the grid of QCAL,
+    #or outBand itself if given (dataset and filename are None then, as there is no file to close)
+def reflectanceOutput(QCAL, reflectance, outBand=None):
+    if outBand is not None:
+        return None, outBand, None
+    outraster_open = raster.create_rasterfile(QCAL, reflectance, gdal.GDT_Float32, -9999)
+    return outraster_open, outraster_open.GetRasterBand(1), reflectance
+
+
 #Calculate the solar distance based on day of year (doy)   
 def calcSolarDist (doy):
 
@@ -264,34 +354,28 @@ def cleanList(bandList):
     return bandList
 
 
-#////////////////////////////////////MAIN LOOP///////////////////////////////////////
-if __name__ == "__main__":
-    #Parameters from input
-        #input format is python full-script-path [relative path of metadata file, "SITType", true/false, bands]
-        #note sys.argv[0] is automatically the path to the dir where the script is executed
-        #here, you must be within the imagery folder for the script to run
-        #true/false indicates whether or not to keep the intermediary radiance files
-    ##print 'cwd is ', os.getcwd()
-    ##os.path.dirname(os.path.abspath(sys.argv[0]))
-    ##print 'cwd is now ', os.getcwd()
-    metadataPath = sys.argv[1]
-    metadataName = sys.argv[2]
-    SIType = str(sys.argv[3])
-    keepRad = str(sys.argv[4])
-    scaleFactor = 1 ##float(sys.argv[4]) #scalefactor is not in the handbook as part of the calculation, but for simplicity I'm keeping the variable...
-    #bandList must be entered as a list of band numbers with no seperators (e.g. 125, not 1;2;5 nor 1,2,5)
-    bandList = cleanList(sys.argv[5]) #must change this to sys.argv[5] if scaleFactor is included as an input
-    #print 'bandList is: ', bandList
-    
-    metadataFile = open(metadataPath+metadataName)
-    metadata = readMetadata(metadataFile)
-    metadataFile.close()
-    
-    successful = []
-    failed = []
-    
-    for band in bandList:
-        band = str(band)
+#Separates optional "--name value" pairs (e.g. --tile 64) from the positional command line arguments
+def splitOptions(argv):
+    args = []
+    options = {}
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith('--') and i+1 < len(argv):
+            options[argv[i][2:]] = argv[i+1]
+            i += 2
+        else:
+            args.append(argv[i])
+            i += 1
+
+    return args, options
+
+
+#Converts a single band to TOA reflectance (the body of the main loop)
+    #returns (BANDFILE metadata key, reflectance filename, None) on success or (None, None, error message) on failure
+    #outBand (optional) is the band of a multi-band stack to write the reflectance into (see writeReflectanceStack)
+def processBand(metadata, band, metadataPath, SIType, keepRad, scaleFactor, tileMB=None, outBand=None):
+    band = str(band)
+    try:
         metlist = acquireMetadata(metadata, band)
         SPACECRAFT_ID = metlist[0] 
         
@@ -306,26 +390,10 @@ if __name__ == "__main__":
             ESUNVAL = "b" + band
             
             #print 'bandfile is ', metadata[BANDFILE] #
-            try:
-                radianceRaster = calcRadiance(metadata[LMAX], metadata[LMIN], metadata[QCALMAX], metadata[QCALMIN], metadataPath, metadata[BANDFILE], band)
-                #print 'radianceRaster successfully executed'    
-
-                doy = calcDOY(metadata[DATE])
-                #print 'doy is ', doy    #
-                        
-                reflectanceRaster = calcReflectance(calcSolarDist(calcDOY(metadata[DATE])), getESUN(ESUNVAL, SIType), metadata['SUN_ELEVATION'], radianceRaster, metadataPath, scaleFactor)
-                #print 'reflectanceRaster successfully executed'
-                
-                #simply deletes the unneeded radianceRaster
-                if keepRad != 'true':
-                    cmd = 'rm -f ' + radianceRaster
-                    os.system(cmd)
-    
-                successful.append(BANDFILE)
-    
-            except Exception, e:
-                failed.append(band)
-                failed.append(str(e))
+            #radiance and reflectance are computed in a single pass from the DN values (no intermediary radiance file unless keepRad is 'true')
+            reflectanceRaster = calcReflectanceFromDN(metadata[LMAX], metadata[LMIN], metadata[QCALMAX], metadata[QCALMIN], calcSolarDist(calcDOY(metadata[DATE])),
+                                                      getESUN(ESUNVAL, SIType), metadata['SUN_ELEVATION'], metadataPath, metadata[BANDFILE], band, scaleFactor, keepRad, tileMB, outBand)
+            #print 'reflectanceRaster successfully executed'
                 
         #Landsat 8 reflectance calculation (only)
         elif metadata["SPACECRAFT_ID"] == 'LANDSAT_8':
@@ -335,16 +403,134 @@ if __name__ == "__main__":
             DATE = metlist[4]
         
             #print 'bandfile is ', metadata[BANDFILE] #
-            
-            try:
-                reflectanceRaster = LS8_calcReflectance(metadata[REFLECTANCE_MULT], metadata[REFLECTANCE_ADD], metadata['SUN_ELEVATION'], metadataPath, metadata[BANDFILE])
-                #print 'reflectanceRaster successfully executed' #
+            reflectanceRaster = LS8_calcReflectance(metadata[REFLECTANCE_MULT], metadata[REFLECTANCE_ADD], metadata['SUN_ELEVATION'], metadataPath, metadata[BANDFILE], band, tileMB, outBand)
+            #print 'reflectanceRaster successfully executed' #
+
+        else:
+            return None, None, 'unsupported SPACECRAFT_ID ' + metadata["SPACECRAFT_ID"]
+
+    except Exception, e:
+        return None, None, str(e)
+
+    return BANDFILE, reflectanceRaster, None
+
+
+#multiprocessing.Pool.map passes a single argument, so the processBand arguments are packed in a tuple
+def processBandJob(job):
+    return processBand(*job)
+
+
+#Converts all the bands in bandList into a single multi-band Float32 GeoTiff (band k of the stack = k-th band of bandList)
+    #interleave is 'band' or 'pixel' (all values of a pixel stored together); npy='true' also writes a .npy memmap sidecar
+    #all the bands must have the same size (e.g. not band 8 with the 30m bands)
+    #returns the stack filename and a list of processBand results, in bandList order
+def writeReflectanceStack(metadata, bandList, metadataPath, SIType, keepRad, scaleFactor, tileMB=None, interleave='band', npy='false'):
+    bandfiles = []
+    for band in bandList:
+        metlist = acquireMetadata(metadata, str(band))
+        bandfiles.append(metadataPath + metadata[metlist[1]])
+    templates = [raster.get_template(f) for f in bandfiles]
+    for f, t in zip(bandfiles, templates):
+        if (t.xsize, t.ysize) != (templates[0].xsize, templates[0].ysize):
+            raise ValueError('Can only stack bands of the same size: ' + f + ' differs from ' + bandfiles[0])
+
+    filename_pref = os.path.basename(os.path.dirname(metadataPath))
+    stack = metadataPath + filename_pref + '_B' + ''.join([str(b) for b in bandList]) + '_refl_stack.tif'
+    #the bands are written one after the other, which a pixel interleaved file would have to rewrite block by block:
+        #a pixel stack is written band interleaved to an uncompressed working file and converted once all bands are in
+        #('cog' files already have a working file, which close_rasterfile copies with the requested interleave)
+    cog = raster.output_profile['name'] == 'cog'
+    convert = interleave.lower() == 'pixel' and not cog
+    if convert:
+        working = stack[:-4] + '_bands.tif'
+        stack_open = templates[0].create(working, gdal.GDT_Float32, -9999, 'default', len(bandList), ['INTERLEAVE=BAND'])
+    else:
+        stack_open = templates[0].create(stack, gdal.GDT_Float32, -9999, bands=len(bandList), options=['INTERLEAVE=BAND'])
+
+    results = []
+    for k, band in enumerate(bandList):
+        outBand = stack_open.GetRasterBand(k + 1)
+        outBand.SetDescription('B' + str(band))
+        result = processBand(metadata, band, metadataPath, SIType, keepRad, scaleFactor, tileMB, outBand)
+        #a band that failed (possibly half written) is set to nodata instead of being left at 0
+        if result[2] is not None:
+            outBand.Fill(-9999)
+        results.append(result)
+        outBand = None
+
+    if cog:
+        stack_open = raster.close_rasterfile(stack_open, ['INTERLEAVE=' + interleave.upper()])
+    elif not convert:
+        stack_open = raster.close_rasterfile(stack_open)
+    else:
+        stack_open.FlushCache()
+        stack_out = gdal.Translate(stack, stack_open, creationOptions=raster.creation_options(gdal.GDT_Float32) + ['INTERLEAVE=PIXEL'])
+        stack_out = None
+        stack_open = None
+        raster.forget_template(stack)
+        raster.unlink_raster(working)
+    if npy == 'true':
+        raster.stack_to_npy(stack, stack[:-4] + '.npy', interleave, tileMB)
+    return stack, results
+
+
+#////////////////////////////////////MAIN LOOP///////////////////////////////////////
+if __name__ == "__main__":
+    #Parameters from input
+        #input format is python full-script-path [relative path of metadata file, "SITType", true/false, bands]
+        #note sys.argv[0] is automatically the path to the dir where the script is executed
+        #here, you must be within the imagery folder for the script to run
+        #true/false indicates whether or not to keep the intermediary radiance files
+    ##print 'cwd is ', os.getcwd()
+    ##os.path.dirname(os.path.abspath(sys.argv[0]))
+    ##print 'cwd is now ', os.getcwd()
+    #optional: --tile MB streams each band in block-aligned windows of at most MB megabytes (bounds memory use for large bands)
+    #optional: --workers N converts up to N bands at once in separate processes
+    #optional: --stack band/pixel writes all bands into one multi-band file (--npy true adds a .npy memmap copy)
+    args, options = splitOptions(sys.argv)
+    metadataPath = args[1]
+    metadataName = args[2]
+    SIType = str(args[3])
+    keepRad = str(args[4])
+    scaleFactor = 1 ##float(sys.argv[4]) #scalefactor is not in the handbook as part of the calculation, but for simplicity I'm keeping the variable...
+    #bandList must be entered as a list of band numbers with no seperators (e.g. 125, not 1;2;5 nor 1,2,5)
+    bandList = cleanList(args[5]) #must change this to sys.argv[5] if scaleFactor is included as an input
+    tileMB = float(options['tile']) if 'tile' in options else None
+    workers = int(options.get('workers', 1))
+    if 'profile' in options:
+        raster.set_output_profile(options['profile'])
+    #print 'bandList is: ', bandList
+    
+    metadataFile = open(metadataPath+metadataName)
+    metadata = readMetadata(metadataFile)
+    metadataFile.close()
+    
+    successful = []
+    failed = []
     
-                successful.append(BANDFILE)
+    #bands are independent once the metadata is read, so they can be sent to a pool of worker processes
+        #(results come back in bandList order either way)
+    jobs = [(metadata, str(band), metadataPath, SIType, keepRad, scaleFactor, tileMB) for band in bandList]
+    if 'stack' in options:
+        #all bands go into one file, so they are written one after the other
+        stack, results = writeReflectanceStack(metadata, bandList, metadataPath, SIType, keepRad, scaleFactor, tileMB,
+                                               options['stack'], options.get('npy', 'false'))
+        print 'Reflectance stack: ' + stack
+    #a pool is only worth starting for two bands or more (and Pool(0) raises when there are none)
+    elif workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        results = pool.map(processBandJob, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [processBandJob(job) for job in jobs]
     
-            except Exception, e:
-                failed.append(band)
-                failed.append(str(e))                        
+    for job, (BANDFILE, reflectanceRaster, error) in zip(jobs, results):
+        if error is None:
+            successful.append(BANDFILE)
+        else:
+            failed.append(job[1])
+            failed.append(error)
     
     if successful:
        print "The following files were converted successfully:"
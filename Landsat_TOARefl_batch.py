@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+DESCRIPTION: batch driver for Landsat_TOARefl; converts the requested bands of many scenes
+to top of atmosphere reflectance in a single process (one pool of workers for all scenes)
+and keeps a manifest of finished jobs so an interrupted run only redoes what is missing
+
+SYNTAX:
+python full_path_to_script/Landsat_TOARefl_batch.py ["SITType", true/false, bands, directories and/or _MTL.txt files...] [--workers N] [--tile MB] [--profile name] [--manifest file] [--index file]
+    directories are searched recursively for files ending in _MTL.txt
+    "SITType", true/false and bands are the same as for Landsat_TOARefl and apply to every scene
+    --manifest file (optional) is the job record (default: toarefl_manifest.txt in the current directory);
+        each finished (scene, band) job is appended as a tab separated line: MTL file, band, status (done/failed), output file, error
+        jobs already marked done (and whose output still exists) are skipped when the run is restarted
+    --index file (optional) is a metadata index built with metadata_index.py; scenes found in it are not re-parsed
+
+NOTES:
+metadata for each scene is read once; the (scene, band) jobs run on a pool of worker processes
+"""
+
+import sys, os
+import multiprocessing
+import Landsat_TOARefl as toa
+import metadata_index
+
+##########  Functions  ##########
+#reads the job manifest into a dictionary of (MTL file, band): [status, output file, error]
+    #later lines override earlier ones, so the last recorded attempt of a job wins
+def readManifest(manifest):
+    jobs = {}
+    if not os.path.exists(manifest):
+        return jobs
+
+    f = open(manifest, 'r')
+    for line in f:
+        val = line.rstrip('\n').split('\t')
+        if len(val) == 5:
+            jobs[(val[0], val[1])] = val[2:]
+    f.close()
+
+    return jobs
+
+
+#appends one finished job to the manifest (flushed immediately so a killed run keeps its record)
+def recordJob(f, mtl, band, status, output, error):
+    f.write('\t'.join([mtl, band, status, output or '', (error or '').replace('\t', ' ').replace('\n', ' ')]) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+
+#worker for one (scene, band) job; returns the job key along with the processBand result
+def runJob(job):
+    mtl, band, args = job
+    return (mtl, band) + toa.processBand(*args)
+
+
+#////////////////////////////////////MAIN LOOP///////////////////////////////////////
+if __name__ == "__main__":
+    args, options = toa.splitOptions(sys.argv)
+    SIType = str(args[1])
+    keepRad = str(args[2])
+    bandList = toa.cleanList(args[3])
+    mtlFiles = metadata_index.findMetadataFiles(args[4:])
+    scaleFactor = 1
+    tileMB = float(options['tile']) if 'tile' in options else None
+    workers = int(options.get('workers', 1))
+    manifest = options.get('manifest', 'toarefl_manifest.txt')
+    index = options.get('index')
+    if 'profile' in options:
+        toa.raster.set_output_profile(options['profile'])
+
+    done = readManifest(manifest)
+
+    #build the list of jobs still to do (metadata is read once per scene)
+    jobs = []
+    skipped = 0
+    for mtl in mtlFiles:
+        todo = []
+        for band in bandList:
+            status = done.get((mtl, band))
+            if status and status[0] == 'done' and os.path.exists(status[1]):
+                skipped += 1
+            else:
+                todo.append(band)
+        if not todo:
+            continue
+
+        metadata = None
+        if index:
+            metadata = metadata_index.loadMetadata(index, mtl)
+        if metadata is None:
+            metadataFile = open(mtl)
+            metadata = toa.readMetadata(metadataFile)
+            metadataFile.close()
+        metadataPath = os.path.dirname(mtl) + os.sep
+        for band in todo:
+            jobs.append((mtl, band, (metadata, band, metadataPath, SIType, keepRad, scaleFactor, tileMB)))
+
+    print str(len(mtlFiles)) + ' scenes, ' + str(len(jobs)) + ' jobs to run, ' + str(skipped) + ' already done'
+    if not jobs:
+        sys.exit(0)
+
+    successful = 0
+    failed = []
+    f = open(manifest, 'a')
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        results = pool.imap_unordered(runJob, jobs)
+    else:
+        pool = None
+        results = (runJob(job) for job in jobs)
+
+    for mtl, band, BANDFILE, reflectanceRaster, error in results:
+        if error is None:
+            recordJob(f, mtl, band, 'done', reflectanceRaster, None)
+            successful += 1
+        else:
+            recordJob(f, mtl, band, 'failed', None, error)
+            failed.append((mtl, band, error))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    f.close()
+
+    print str(successful) + ' jobs were converted successfully'
+    for mtl, band, error in failed:
+        print os.path.basename(mtl) + " Band" + band + " failed to execute. Error: " + error
@@ -9,68 +9,418 @@ functions to compute Landsat band math, many of which include a masking prior
 to calculations and/or a thresholding post calculations
 
 functions:
+    evaluate any band math expression over named rasters, window by window (calc_expression, Expression)
     NDSI (using green and SWIR/NIR 1.55-1.75micron)
     two band average
+    (both are expressions: NDSI_EXPRESSION and TWOB_AVG_EXPRESSION, which also work on arrays or windows of them, e.g. from pipeline.py)
+    several indices (e.g. NDSI, NDVI, NDWI, two band average) from one read of the bands, as separate files or a stack (compute_indices)
+    histogram of an index in one pass (index_histogram), to get the classified count/area for many thresholds (threshold_sweep)
+        or an automatic threshold (otsu_threshold, valley_threshold)
+
+EXAMPLE:
+    calc_expression("(b2 - b5) / (b2 + b5) > 0.4 & mask == 1", {'b2': green_file, 'b5': swir_file, 'mask': mask_file},
+                    'snow.tif', tileMB=64)
 
 NOTES:
 Pay attention to data type (in and out) to avoid "wrong" math and odd results
+Bands can be given as a filename (band 1) or as a (filename, band number) tuple, e.g. for a Landsat_TOARefl reflectance stack
+Classifications (classify_NDSI, classify_twob_avg) are written as Byte: 0/1, and 255 for nodata (optionally as 1 bit files)
+Division by zero gives nodata (NaN), and so does any pixel that is nodata in one of the raster inputs
+Expressions are evaluated with numexpr when it is installed, otherwise with numpy
 
 """
 
 #import sys, os, math
-from osgeo import gdal
+import os
+import ast
+import numbers
+from osgeo import gdal, gdal_array
 import numpy as np
+import raster
+
+#numexpr (optional) evaluates whole expressions in one multithreaded pass without numpy temporaries
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
 #def array_thresh (inarray,threshold)
 
+##########  Expressions  ##########
+#operators allowed in band math expressions: numpy function and numexpr symbol
+    #(division is done with safe_divide)
+BINARY_OPS = {ast.Add: (np.add, '+'), ast.Sub: (np.subtract, '-'), ast.Mult: (np.multiply, '*'),
+              ast.Div: (None, '/'), ast.Pow: (np.power, '**'), ast.Mod: (np.mod, '%')}
+COMPARE_OPS = {ast.Eq: (np.equal, '=='), ast.NotEq: (np.not_equal, '!='), ast.Lt: (np.less, '<'),
+               ast.LtE: (np.less_equal, '<='), ast.Gt: (np.greater, '>'), ast.GtE: (np.greater_equal, '>=')}
+#functions allowed in band math expressions (all of them also exist in numexpr)
+FUNCTIONS = {'abs': np.abs, 'sqrt': np.sqrt, 'log': np.log, 'log10': np.log10, 'exp': np.exp, 'where': np.where}
 
-#classifies the image using the NDSI and a given threshold, then writes to a raster file
-    #sets a no-data value of -99
-def classify_NDSI (bandi, bandj, outfile, threshold):
-    #declare variables
-    NODATA = -99
-    inTYPE = np.float32
-    outTYPE = gdal.GDT_Float32
-    
-    #open input files, read in arrays, and convert to signed int for calculation    
-    bandi_open = gdal.Open(bandi)
-    bandi_array = bandi_open.GetRasterBand(1).ReadAsArray()
-    bandi_array = bandi_array.astype(inTYPE, copy=False)
-    bandj_open = gdal.Open(bandj)
-    bandj_array = bandj_open.GetRasterBand(1).ReadAsArray()
-    bandj_array = bandj_array.astype(inTYPE, copy=False)
-    
-    #compute NDSI ((i-j)/(i+j)), including zero handling for division
-    band_diff = bandi_array - bandj_array    
-    band_sum = bandi_array + bandj_array
-    is_zero = (band_sum==0)
-    band_sum[is_zero] = 1
-    class_array = band_diff / band_sum
-    class_array[is_zero] = NODATA 
-    
-#    print 'bandi val ' + str(bandi_array[3475,6137]) + ' bandj val ' + str(bandj_array[3475,6137])
-#    print 'band_diff val ' + str(band_diff[3475,6137]) + ' band_sum val ' + str(band_sum[3475,6137])
-#    print 'NDSI: ' + str(class_array[3475,6137])
-    
-    #threshold image
-#    outfile_array = class_array
-    outfile_array = class_array > threshold
+#divides a by b, giving NaN (which becomes nodata) where b == 0
+def safe_divide (a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(b == 0, np.nan, np.true_divide(a, b))
 
-    
-    #get geo info from original (uses bandi file/info)
-    geo = bandi_open.GetGeoTransform()
-    #create new GeoTiff, apply georef info, and write new raster
-    outfile_open = gdal.GetDriverByName('GTiff').Create(outfile, bandi_array.shape[1], bandi_array.shape[0], 1, outTYPE)
-    outfile_open.SetGeoTransform((geo[0], geo[1], geo[2], geo[3], geo[4], geo[5]))
-    outfile_open.SetProjection(bandi_open.GetProjection())
-    outfile_open.GetRasterBand(1).WriteArray(outfile_array)
-    outfile_open.GetRasterBand(1).SetNoDataValue(NODATA)
-    
-   
-    outfile_open = None
-    bandi_open = None
-    bandj_open = None
-    print 'NDSI complete'    
+
+#a band math expression over named inputs, e.g. "(b2 - b5) / (b2 + b5) > 0.4 & mask == 1"
+    #parsed (and checked against the operators/functions above) once, then evaluated on arrays or windows of them
+    #& and | (or 'and' and 'or') combine conditions and bind looser than comparisons; 'not' negates one; nan is NaN
+    #names lists the inputs used by the expression, in order of appearance
+    #nodata (optional) is a second expression flagging more nodata pixels; comparisons with NaN are False, so a
+    #thresholded expression (e.g. x / y > t) needs it to keep the pixels where it divides by zero as nodata
+class Expression(object):
+    def __init__(self, expression, nodata=None):
+        self.expression = expression
+        self.names = []
+        try:
+            self.tree = ast.parse(expression.replace('&', ' and ').replace('|', ' or ').strip(), mode='eval').body
+        except SyntaxError, e:
+            raise ValueError('Invalid band math expression ' + expression + ': ' + str(e))
+        #checking the expression also converts it for numexpr
+        ne_expression = self._numexpr(self.tree)
+        self.ne_expression = ne_expression if numexpr is not None else None
+        self.nodata = None
+        if nodata is not None:
+            self.nodata = Expression(nodata)
+            self.names.extend(name for name in self.nodata.names if name not in self.names)
+
+    #checks a node of the expression (collecting input names) and returns it as a numexpr expression string
+    def _numexpr(self, node):
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPS:
+            left = self._numexpr(node.left)
+            right = self._numexpr(node.right)
+            if isinstance(node.op, ast.Div):
+                return 'where((' + right + ') == 0, nan, (' + left + ') / (' + right + '))'
+            return '(' + left + ' ' + BINARY_OPS[type(node.op)][1] + ' ' + right + ')'
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd, ast.Not)):
+            symbol = {ast.USub: '-', ast.UAdd: '', ast.Not: '~'}[type(node.op)]
+            return symbol + '(' + self._numexpr(node.operand) + ')'
+        if isinstance(node, ast.BoolOp):
+            symbol = ' & ' if isinstance(node.op, ast.And) else ' | '
+            return '(' + symbol.join(self._numexpr(value) for value in node.values) + ')'
+        if isinstance(node, ast.Compare) and all(type(op) in COMPARE_OPS for op in node.ops):
+            operands = [self._numexpr(node.left)] + [self._numexpr(value) for value in node.comparators]
+            pairs = ['(' + operands[i] + ' ' + COMPARE_OPS[type(op)][1] + ' ' + operands[i + 1] + ')' for i, op in enumerate(node.ops)]
+            return '(' + ' & '.join(pairs) + ')'
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS \
+                and not node.keywords and not getattr(node, 'starargs', None) and not getattr(node, 'kwargs', None):
+            return node.func.id + '(' + ', '.join(self._numexpr(arg) for arg in node.args) + ')'
+        if isinstance(node, ast.Name):
+            if node.id not in ('nan', 'True', 'False') and node.id not in self.names:
+                self.names.append(node.id)
+            return node.id
+        if type(node).__name__ in ('Num', 'Constant') and isinstance(getattr(node, 'n', None), numbers.Number):
+            return repr(node.n)
+        raise ValueError('Not allowed in a band math expression: ' + type(node).__name__ + ' (in ' + self.expression + ')')
+
+    #evaluates a checked node with numpy, given a dictionary of input name: array (or number)
+    def _eval(self, node, env):
+        if isinstance(node, ast.BinOp):
+            if isinstance(node.op, ast.Div):
+                return safe_divide(self._eval(node.left, env), self._eval(node.right, env))
+            return BINARY_OPS[type(node.op)][0](self._eval(node.left, env), self._eval(node.right, env))
+        if isinstance(node, ast.UnaryOp):
+            value = self._eval(node.operand, env)
+            if isinstance(node.op, ast.Not):
+                return np.logical_not(value)
+            return np.negative(value) if isinstance(node.op, ast.USub) else value
+        if isinstance(node, ast.BoolOp):
+            func = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            return reduce(func, [self._eval(value, env) for value in node.values])
+        if isinstance(node, ast.Compare):
+            operands = [self._eval(node.left, env)] + [self._eval(value, env) for value in node.comparators]
+            return reduce(np.logical_and, [COMPARE_OPS[type(op)][0](operands[i], operands[i + 1]) for i, op in enumerate(node.ops)])
+        if isinstance(node, ast.Call):
+            return FUNCTIONS[node.func.id](*[self._eval(arg, env) for arg in node.args])
+        if isinstance(node, ast.Name):
+            if node.id in env:
+                return env[node.id]
+            return {'nan': np.nan, 'True': True, 'False': False}[node.id]
+        return node.n
+
+    #evaluates the expression (with numexpr if it is installed) given a dictionary of input name: array (or number)
+    def evaluate(self, env):
+        if self.ne_expression is not None:
+            env = dict(env)
+            env['nan'] = np.nan
+            return numexpr.evaluate(self.ne_expression, local_dict=env)
+        return self._eval(self.tree, env)
+
+    #evaluates the expression and returns the result as an array of the numpy data type dtype, and the nodata mask
+        #of the result: is_nodata (from raster.nodata_mask/merge_nodata) plus the pixels where the result is NaN
+        #or the nodata expression is true
+    def evaluate_masked(self, env, is_nodata, dtype):
+        result = np.asarray(self.evaluate(env))
+        if result.dtype.kind == 'f':
+            is_nodata = raster.merge_nodata(is_nodata, np.isnan(result))
+        if self.nodata is not None:
+            is_nodata = raster.merge_nodata(is_nodata, np.asarray(self.nodata.evaluate(env), bool) & np.ones(result.shape, bool))
+        return result.astype(dtype, copy=False), is_nodata
+
+    #evaluates the expression and returns the result as an array of the numpy data type dtype,
+        #with the NODATA value where is_nodata (from raster.nodata_mask/merge_nodata) is set or the result is NaN
+    def apply(self, env, is_nodata, dtype, NODATA=-99):
+        result, is_nodata = self.evaluate_masked(env, is_nodata, dtype)
+        return raster.set_nodata(result, is_nodata, NODATA)
+
+
+#returns expression as an Expression (parsing it if it is a string)
+def as_expression (expression):
+    if isinstance(expression, Expression):
+        return expression
+    return Expression(expression)
+
+
+#splits the inputs (dictionary of name: filename, (filename, band number) tuple or number) used by an expression into
+    #a list of (name, raster input) in order of appearance and a dictionary of name: constant
+def split_inputs (expression, inputs):
+    rasters = []
+    constants = {}
+    for name in expression.names:
+        if name not in inputs:
+            raise ValueError('No input given for ' + name + ' (in ' + expression.expression + ')')
+        if isinstance(inputs[name], numbers.Number):
+            constants[name] = inputs[name]
+        else:
+            rasters.append((name, inputs[name]))
+    if not rasters:
+        raise ValueError('No raster input used in ' + expression.expression)
+    return rasters, constants
+
+
+#evaluates a band math expression (string or Expression) over named inputs (see split_inputs) and writes the result
+    #to outfile (georef info from the first raster input in the expression), window by window (see raster.block_windows)
+    #inputs are read as float32; pixels that are nodata in any raster input, or NaN (e.g. x/0), get the NODATA value
+    #nbits (optional) packs the output into that many bits per pixel (e.g. 1 for a 0/1 classification); if NODATA does
+    #not fit in nbits, nodata pixels are written as 0 and flagged in an internal mask band instead
+def calc_expression (expression, inputs, outfile, outTYPE=gdal.GDT_Float32, NODATA=-99, tileMB=None, nbits=None):
+    expression = as_expression(expression)
+    rasters, constants = split_inputs(expression, inputs)
+    opens = []
+    bands = []
+    for name, infile in rasters:
+        infile_open, band = raster.open_band(infile)
+        opens.append(infile_open)
+        bands.append((name, band))
+
+    use_mask = nbits is not None and not 0 <= NODATA < 2 ** nbits
+    options = ['NBITS=' + str(nbits)] if nbits is not None else None
+    outfile_open = raster.get_template(rasters[0][1]).create(outfile, outTYPE, None if use_mask else NODATA, options=options)
+    outband = outfile_open.GetRasterBand(1)
+    if use_mask:
+        outmask = raster.create_mask_band(outfile_open)
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(outTYPE)
+    for xoff, yoff, xsize, ysize in raster.block_windows(outband, tileMB):
+        env = dict(constants)
+        masks = []
+        for name, band in bands:
+            array = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            masks.append(raster.nodata_mask(band, array, xoff, yoff))
+            env[name] = array.astype(np.float32, copy=False)
+        if use_mask:
+            result, is_nodata = expression.evaluate_masked(env, raster.merge_nodata(*masks), dtype)
+            outband.WriteArray(raster.set_nodata(result, is_nodata, 0), xoff, yoff)
+            valid = np.full(result.shape, 255, np.uint8)
+            outmask.WriteArray(raster.set_nodata(valid, is_nodata, 0), xoff, yoff)
+        else:
+            outband.WriteArray(expression.apply(env, raster.merge_nodata(*masks), dtype, NODATA), xoff, yoff)
+
+    outband = None
+    outmask = None
+    outfile_open = raster.close_rasterfile(outfile_open)
+    opens = None
+    return outfile
+
+
+##########  Indices  ##########
+#indices known to compute_indices by name (not thresholded), over inputs named after the bands they use
+INDICES = {'NDSI': Expression('(green - swir) / (green + swir)'),
+           'NDVI': Expression('(nir - red) / (nir + red)'),
+           'NDWI': Expression('(green - nir) / (green + nir)'),
+           'twob_avg': Expression('where(mask == 1, (bandi + bandj) / 2, nan)')}
+
+#computes several indices from one read of the bands they share: each raster input is read (and cast to float32)
+    #once per window and every index is evaluated from it (see calc_expression for inputs and nodata)
+    #indices is a list of names from INDICES or of (name, expression) tuples
+    #stack=False writes each index to outfile[:-4] + '_' + name + '.tif'; stack=True writes them as the bands of outfile
+    #(in the order given, band descriptions set to the index names); returns the list of files written
+def compute_indices (indices, inputs, outfile, stack=False, outTYPE=gdal.GDT_Float32, NODATA=-99, tileMB=None):
+    names = []
+    expressions = []
+    for index in indices:
+        if isinstance(index, tuple):
+            name, expression = index
+        elif index in INDICES:
+            name, expression = index, INDICES[index]
+        else:
+            raise ValueError('Unknown index ' + str(index) + ' (use ' + ', '.join(sorted(INDICES)) + ' or a (name, expression) tuple)')
+        names.append(name)
+        expressions.append(as_expression(expression))
+
+    #open every band used by any of the indices once, by (file name, band number), whatever the names it is given
+        #(e.g. green for NDSI and bandi for twob_avg); sources maps each input name to its band
+    opens = []
+    bands = []
+    sources = {}
+    constants = {}
+    for expression in expressions:
+        rasters, more_constants = split_inputs(expression, inputs)
+        constants.update(more_constants)
+        for name, infile in rasters:
+            source = infile if isinstance(infile, tuple) else (infile, 1)
+            source = (os.path.abspath(source[0]) if os.path.exists(source[0]) else source[0], source[1])
+            if source not in [band[0] for band in bands]:
+                infile_open, band = raster.open_band(infile)
+                opens.append(infile_open)
+                bands.append((source, band))
+            sources[name] = source
+
+    template = raster.get_template(bands[0][0])
+    if stack:
+        outfiles = [outfile]
+        outfile_opens = [template.create(outfile, outTYPE, NODATA, bands=len(names))]
+        outbands = [outfile_opens[0].GetRasterBand(i + 1) for i in range(len(names))]
+        for outband, name in zip(outbands, names):
+            outband.SetDescription(name)
+    else:
+        outfiles = [outfile[:-4] + '_' + name + '.tif' for name in names]
+        outfile_opens = [template.create(name, outTYPE, NODATA) for name in outfiles]
+        outbands = [outfile_open.GetRasterBand(1) for outfile_open in outfile_opens]
+
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(outTYPE)
+    for xoff, yoff, xsize, ysize in raster.block_windows(outbands[0], tileMB):
+        arrays = {}
+        masks = {}
+        for source, band in bands:
+            array = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            masks[source] = raster.nodata_mask(band, array, xoff, yoff)
+            arrays[source] = array.astype(np.float32, copy=False)
+        env = dict(constants)
+        for name, source in sources.items():
+            env[name] = arrays[source]
+        for expression, outband in zip(expressions, outbands):
+            is_nodata = raster.merge_nodata(*[masks[sources[name]] for name in expression.names if name in sources])
+            outband.WriteArray(expression.apply(env, is_nodata, dtype, NODATA), xoff, yoff)
+
+    outbands = None
+    outfile_opens = [raster.close_rasterfile(outfile_open) for outfile_open in outfile_opens]
+    opens = None
+    print 'indices complete: ' + ', '.join(names)
+
+    return outfiles
+
+
+#nodata class of classification outputs (0 and 1 are the classes)
+CLASS_NODATA = 255
+#NDSI ((i-j)/(i+j)), and thresholded; i+j == 0 gives nodata (also after thresholding)
+NDSI_INDEX = Expression('(bandi - bandj) / (bandi + bandj)')
+NDSI_EXPRESSION = Expression('(bandi - bandj) / (bandi + bandj) > threshold', nodata='bandi + bandj == 0')
+#average of two bands, and thresholded; pixels where mask != 1 are nodata
+TWOB_AVG_INDEX = Expression('where(mask == 1, (bandi + bandj) / 2, nan)')
+TWOB_AVG_EXPRESSION = Expression('(bandi + bandj) / 2 > threshold', nodata='mask != 1')
+
+
+##########  Thresholds  ##########
+#computes a fixed-bin histogram of an expression (e.g. NDSI_INDEX) over its valid pixels in one pass (window by window)
+    #values outside value_range are counted in the first/last bin
+    #returns (counts, bin edges, pixel area in map units) for threshold_sweep, otsu_threshold and valley_threshold
+def index_histogram (expression, inputs, bins=1000, value_range=(-1, 1), tileMB=None):
+    expression = as_expression(expression)
+    rasters, constants = split_inputs(expression, inputs)
+    opens = []
+    bands = []
+    for name, infile in rasters:
+        infile_open, band = raster.open_band(infile)
+        opens.append(infile_open)
+        bands.append((name, band))
+
+    counts = np.zeros(bins, np.int64)
+    edges = np.linspace(value_range[0], value_range[1], bins + 1)
+    for xoff, yoff, xsize, ysize in raster.block_windows(bands[0][1], tileMB):
+        env = dict(constants)
+        masks = []
+        for name, band in bands:
+            array = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            masks.append(raster.nodata_mask(band, array, xoff, yoff))
+            env[name] = array.astype(np.float32, copy=False)
+        values, is_nodata = expression.evaluate_masked(env, raster.merge_nodata(*masks), np.float32)
+        if is_nodata is not None:
+            values = values[~is_nodata]
+        values = np.clip(values, value_range[0], value_range[1])
+        counts += np.histogram(values, bins, value_range)[0]
+
+    geo = raster.get_template(rasters[0][1]).geotransform
+    opens = None
+    return counts, edges, abs(geo[1] * geo[5])
+
+
+#returns a list of (threshold, pixel count, area) of the pixels classified by each threshold (value > threshold)
+    #from an index_histogram; thresholds are resolved to the nearest bin edge, so pick bins to match the precision needed
+def threshold_sweep (histogram, thresholds):
+    counts, edges, pixel_area = histogram
+    #pixels in bin i and above
+    above = np.cumsum(counts[::-1])[::-1]
+    sweep = []
+    for threshold in thresholds:
+        #nearest bin edge: the first edge >= threshold or the one before it, whichever is closer
+        i = int(np.searchsorted(edges, threshold))
+        if i > 0 and (i == len(edges) or threshold - edges[i - 1] <= edges[i] - threshold):
+            i -= 1
+        count = int(above[i]) if i < len(counts) else 0
+        sweep.append((threshold, count, count * pixel_area))
+    return sweep
+
+
+#returns the Otsu threshold of an index_histogram (the bin edge maximizing the variance between the two classes)
+def otsu_threshold (histogram):
+    counts, edges, pixel_area = histogram
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight0 = np.cumsum(counts).astype(np.float64)
+    weight1 = weight0[-1] - weight0
+    sum0 = np.cumsum(counts * centers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean0 = sum0 / weight0
+        mean1 = (sum0[-1] - sum0) / weight1
+        between = weight0 * weight1 * (mean0 - mean1) ** 2
+    between[~np.isfinite(between)] = 0
+    return edges[np.argmax(between) + 1]
+
+
+#returns the valley threshold of an index_histogram: the lowest point of the histogram (smoothed over smooth bins)
+    #between its two highest peaks
+def valley_threshold (histogram, smooth=5):
+    counts, edges, pixel_area = histogram
+    smoothed = np.convolve(counts, np.ones(smooth) / smooth, mode='same')
+    inner = smoothed[1:-1]
+    peaks = np.nonzero((inner > smoothed[:-2]) & (inner >= smoothed[2:]))[0] + 1
+    if len(peaks) < 2:
+        raise ValueError('The histogram has less than two peaks, so there is no valley threshold')
+    first, second = sorted(peaks[np.argsort(smoothed[peaks])[-2:]])
+    valley = first + np.argmin(smoothed[first:second + 1])
+    return (edges[valley] + edges[valley + 1]) / 2
+
+
+#automatic threshold methods accepted by classify_NDSI and classify_twob_avg
+AUTO_THRESHOLDS = {'otsu': otsu_threshold, 'valley': valley_threshold}
+
+#returns threshold as is, or computes it with an AUTO_THRESHOLDS method from the histogram of an index
+def choose_threshold (threshold, index, inputs, value_range, tileMB=None):
+    if threshold not in AUTO_THRESHOLDS:
+        return threshold
+    histogram = index_histogram(index, inputs, value_range=value_range, tileMB=tileMB)
+    threshold = AUTO_THRESHOLDS[threshold](histogram)
+    print 'threshold: ' + str(threshold)
+    return threshold
+
+
+#classifies the image using the NDSI and a given threshold, then writes to a raster file
+    #as Byte: 1 above the threshold, 0 below, CLASS_NODATA (255) for nodata; nbits=1 writes a 1 bit file (see calc_expression)
+    #threshold can be 'otsu' or 'valley' to compute it from the histogram of the NDSI first (see index_histogram)
+def classify_NDSI (bandi, bandj, outfile, threshold, tileMB=None, nbits=None):
+    threshold = choose_threshold(threshold, NDSI_INDEX, {'bandi': bandi, 'bandj': bandj}, (-1, 1), tileMB)
+    calc_expression(NDSI_EXPRESSION, {'bandi': bandi, 'bandj': bandj, 'threshold': threshold}, outfile,
+                    gdal.GDT_Byte, CLASS_NODATA, tileMB, nbits)
+    print 'NDSI complete'
     
     return outfile
   
@@ -78,46 +428,12 @@ def classify_NDSI (bandi, bandj, outfile, threshold):
 #given two input band filenames and a mask file to ignore values (!=1),
     #calculates the average of the two bands and 
     #thresholds the image to keep everything above the specified threshold
-def classify_twob_avg (bandi, bandj, mask, outfile, threshold):
-    #declare variables
-    NODATA = -99
-    inTYPE = np.float32
-    outTYPE = gdal.GDT_Float32
-    
-    #open input files, read in arrays, and convert to signed int for calculation        
-    bandi_open = gdal.Open(bandi)
-    bandi_array = bandi_open.GetRasterBand(1).ReadAsArray()
-    bandi_array = bandi_array.astype(inTYPE, copy=False)
-    bandj_open = gdal.Open(bandj)
-    bandj_array = bandj_open.GetRasterBand(1).ReadAsArray()
-    bandj_array = bandj_array.astype(inTYPE, copy=False)
-    
-    mask_open = gdal.Open(mask)
-    mask_array = mask_open.GetRasterBand(1).ReadAsArray()
-    ignore = (mask_array!=1)
-    
-    #compute average
-    band_avg = (bandi_array + bandj_array) / 2
-    band_avg[ignore] = NODATA
-    
-    #threshold image
-    outfile_array = band_avg > threshold
-
-    #get geo info from original (uses bandi file/info)
-    geo = bandi_open.GetGeoTransform()
-    #create new GeoTiff, apply georef info, and write new raster
-    outfile_open = gdal.GetDriverByName('GTiff').Create(outfile, bandi_array.shape[1], bandi_array.shape[0], 1, outTYPE)
-    outfile_open.SetGeoTransform((geo[0], geo[1], geo[2], geo[3], geo[4], geo[5]))
-    outfile_open.SetProjection(bandi_open.GetProjection())
-    outfile_open.GetRasterBand(1).WriteArray(outfile_array)
-    outfile_open.GetRasterBand(1).SetNoDataValue(NODATA)    
-   
-    outfile_open = None
-    bandi_open = None
-    bandj_open = None
-    mask_open = None
+    #(output as for classify_NDSI; ignored pixels are CLASS_NODATA)
+    #threshold can be 'otsu' or 'valley', computed from the histogram of the average over value_range
+def classify_twob_avg (bandi, bandj, mask, outfile, threshold, tileMB=None, nbits=None, value_range=(0, 1)):
+    threshold = choose_threshold(threshold, TWOB_AVG_INDEX, {'bandi': bandi, 'bandj': bandj, 'mask': mask}, value_range, tileMB)
+    calc_expression(TWOB_AVG_EXPRESSION, {'bandi': bandi, 'bandj': bandj, 'mask': mask, 'threshold': threshold},
+                    outfile, gdal.GDT_Byte, CLASS_NODATA, tileMB, nbits)
     print 'band avg complete'    
     
     return outfile   
-
-   
\ No newline at end of file
@@ -38,9 +38,13 @@ import os, os.path
 import time
 import glob
 from itertools import cycle
+import numpy as np
 
 outFormat = 'ESRI Shapefile'
 
+# a sparse read is used while the blocks holding points cover less than this fraction of the band
+sparseFraction = 0.5
+
 def mapToPixel( mX, mY, geoTransform ):
   '''Convert map coordinates to pixel coordinates.
 
@@ -56,6 +60,25 @@ def mapToPixel( mX, mY, geoTransform ):
     pX, pY = applyGeoTransform( mX, mY, invertGeoTransform( geoTransform ) )
   return int( pX + 0.5 ), int( pY + 0.5 )
 
+def mapToPixels( mX, mY, geoTransform ):
+  '''Convert arrays of map coordinates to pixel coordinates (vectorized mapToPixel).
+
+  @param mX              Input map X coordinates (array of doubles)
+  @param mY              Input map Y coordinates (array of doubles)
+  @param geoTransform    Input geotransform (six doubles)
+  @return pX, pY         Output coordinates (two arrays of integers)
+  '''
+  if geoTransform[ 2 ] + geoTransform[ 4 ] != 0:
+    geoTransform = invertGeoTransform( geoTransform )
+    pX = geoTransform[ 0 ] + mX * geoTransform[ 1 ] + mY * geoTransform[ 2 ]
+    pY = geoTransform[ 3 ] + mX * geoTransform[ 4 ] + mY * geoTransform[ 5 ]
+  else:
+    pX = ( mX - geoTransform[ 0 ] ) / geoTransform[ 1 ]
+    pY = ( mY - geoTransform[ 3 ] ) / geoTransform[ 5 ]
+  # a point is in the pixel whose top left corner is at or before it: floor (not int(), which truncates towards 0)
+  # so points left of/above the raster get negative pixel coordinates and fail the bounds check
+  return np.floor( pX ).astype( np.intp ), np.floor( pY ).astype( np.intp )
+
 def pixelToMap( pX, pY, geoTransform ):
   '''Convert pixel coordinates to map coordinates.
 
@@ -108,12 +131,95 @@ def invertGeoTransform( geoTransform ):
 
   return outGeoTransform
 
+def readPoints( inLayer ):
+  '''Collect the feature ids and coordinates of all points of a layer.
+
+  @param inLayer         Input point layer (OGRLayer)
+  @return fids, mX, mY   Output feature ids (list) and coordinates (two arrays of doubles)
+  '''
+  fids = []
+  coords = []
+  inLayer.ResetReading()
+  inFeat = inLayer.GetNextFeature()
+  while inFeat is not None:
+    geom = inFeat.GetGeometryRef()
+    fids.append( inFeat.GetFID() )
+    coords.append( ( geom.GetX(), geom.GetY() ) )
+    inFeat = inLayer.GetNextFeature()
+  coords = np.array( coords, dtype = np.float64 ).reshape( -1, 2 )
+  return fids, coords[ :, 0 ], coords[ :, 1 ]
+
+def transformPoints( mX, mY, coordTransform ):
+  '''Transform arrays of coordinates in one call.
+
+  @param mX              Input X coordinates (array of doubles)
+  @param mY              Input Y coordinates (array of doubles)
+  @param coordTransform  Input transformation (OSRCoordinateTransformation)
+  @return outX, outY     Output coordinates (two arrays of doubles)
+  '''
+  if len( mX ) == 0:
+    return mX, mY
+  res = np.array( coordTransform.TransformPoints( zip( mX, mY, np.zeros( len( mX ) ) ) ), dtype = np.float64 )
+  return res[ :, 0 ], res[ :, 1 ]
+
+def samplePixels( band, pX, pY, inside ):
+  '''Gather the values of an array at pixel coordinates.
+
+  @param band            Input raster values (2D array)
+  @param pX              Input pixel X coordinates (array of integers)
+  @param pY              Input pixel Y coordinates (array of integers)
+  @param inside          Input mask of the points inside the raster (array of booleans)
+  @return values         Output values (array of doubles, NaN for points outside the raster)
+  '''
+  values = np.empty( len( pX ), dtype = np.float64 )
+  values.fill( np.nan )
+  values[ inside ] = band[ pY[ inside ], pX[ inside ] ]
+  return values
+
+def sampleBand( rband, pX, pY, inside, mode = 'auto' ):
+  '''Sample a raster band at pixel coordinates, reading either the whole band or only the blocks holding points.
+
+  @param rband           Input raster band (GDALRasterBand)
+  @param pX              Input pixel X coordinates (array of integers)
+  @param pY              Input pixel Y coordinates (array of integers)
+  @param inside          Input mask of the points inside the raster (array of booleans)
+  @param mode            Input 'full', 'sparse' or 'auto' (sparse while the blocks holding points
+                         cover less than sparseFraction of the band)
+  @return values         Output values (array of doubles, NaN for points outside the raster)
+  '''
+  xSize = rband.XSize
+  ySize = rband.YSize
+  blockX, blockY = rband.GetBlockSize()
+  blocksX = ( xSize + blockX - 1 ) // blockX
+  ids = np.flatnonzero( inside )
+  blockIds = ( pY[ ids ] // blockY ) * blocksX + pX[ ids ] // blockX
+  uniqueIds = np.unique( blockIds )
+
+  if mode == 'full' or ( mode == 'auto' and len( uniqueIds ) * blockX * blockY >= sparseFraction * xSize * ySize ):
+    return samplePixels( rband.ReadAsArray(), pX, pY, inside )
+
+  values = np.empty( len( pX ), dtype = np.float64 )
+  values.fill( np.nan )
+  # points sorted by block, so each block is read once
+  order = np.argsort( blockIds, kind = 'mergesort' )
+  ids = ids[ order ]
+  blockIds = blockIds[ order ]
+  bounds = np.searchsorted( blockIds, np.append( uniqueIds, uniqueIds[ -1 ] + 1 ) ) if len( uniqueIds ) else []
+  for n, blockId in enumerate( uniqueIds ):
+    x0 = ( blockId % blocksX ) * blockX
+    y0 = ( blockId // blocksX ) * blockY
+    block = rband.ReadAsArray( int( x0 ), int( y0 ), int( min( blockX, xSize - x0 ) ), int( min( blockY, ySize - y0 ) ) )
+    points = ids[ bounds[ n ]:bounds[ n + 1 ] ]
+    values[ points ] = block[ pY[ points ] - y0, pX[ points ] - x0 ]
+  return values
+
 # =============================================================================
 
 def usage():
   '''Show usage synopsis.
   '''
-  print 'Usage: extract_values.py [-r] point_shapefile [raster_file(s)] [-d directory_with_rasters]'
+  print 'Usage: extract_values.py [-r] [-s full|sparse|auto] point_shapefile [raster_file(s)] [-d directory_with_rasters]'
+  print '  -s  read whole bands (full), only the blocks holding points (sparse) or choose by point density (auto, default)'
   sys.exit( 1 )
 
 def fileNamesToFileInfos( names ):
@@ -315,6 +421,8 @@ if __name__ == '__main__':
   rasterPath = None
   inShapeName = None
   needTransform = False
+  sampleMode = 'auto'
+  rasterArgs = []
 
   gdal.AllRegister()
 
@@ -342,14 +450,19 @@ if __name__ == '__main__':
         sys.exit( 1 )
       if rasterPath[ len( rasterPath ) - 1 : ] != os.sep:
         rasterPath = rasterPath + os.sep
+    elif arg == '-s':
+      i += 1
+      sampleMode = args[ i ]
+      if sampleMode not in ( 'full', 'sparse', 'auto' ):
+        usage()
     elif inShapeName is None:
       inShapeName = arg
+    else:
+      rasterArgs.append( arg )
     i += 1
     
-  if rasterPath is None and needTransform:
-    inRasters.extend( args[ 3: ] )
-  elif rasterPath is None and not needTransform:
-    inRasters.extend( args[ 2: ] )
+  if rasterPath is None:
+    inRasters.extend( rasterArgs )
   else:
     for f in formats:
       # look for supported rasters in directory
@@ -377,81 +490,59 @@ if __name__ == '__main__':
   # add new fields to the shapefile
   createFields( inLayer, fileInfos )
 
+  # collect the points once
+  fids, mX, mY = readPoints( inLayer )
+
   # init progressbar
-  max = featCount * bands
+  max = bands + len( fids )
   pb = progressBar( max + 1, 65 )
   i = 0
   start = time.time()
-  # process points and rasters
+  # sample every band of every raster at all points at once (list of field name, values, points inside the raster)
+  fieldValues = []
   for f in fileInfos:
-    i += 1
-    pb.update( i )
     gt = f.geotransform
     rasterCRS = f.projection
     #print "Layer", layerCRS.ExportToWkt()
     #print "Raster", rasterCRS.ExportToWkt()   
+    x, y = mX, mY
     if needTransform:
       coordTransform = osr.CoordinateTransformation( layerCRS, rasterCRS )
       if coordTransform is None and needTransform:
         print 'Error while creating coordinate transformation.'
         sys.exit( 1 )
+      x, y = transformPoints( mX, mY, coordTransform )
+    rX, rY = mapToPixels( x, y, gt )
+    inside = ( rX >= 0 ) & ( rX < f.xSize ) & ( rY >= 0 ) & ( rY < f.ySize )
     ds = gdal.Open( f.fileName )
     if f.bands == 1:
+      i += 1
+      pb.update( i )
       shortName = f.fileBaseName[ -10: ]    #must also be edited in def createFields; orig first 10 characters (:10)
-      band = ds.ReadAsArray()
-      inLayer.ResetReading()
-      inFeat = inLayer.GetNextFeature()
-      while inFeat is not None:
-        i += 1
-        pb.update( i )
-        geom = inFeat.GetGeometryRef()
-        x = geom.GetX()
-        y = geom.GetY()
-        #print "BEFORE", x, y
-        if needTransform:
-          res = coordTransform.TransformPoint( x, y, 0 )
-          x = res[ 0 ]
-          y = res[ 1 ]
-        rX, rY = mapToPixel( x, y, gt )
-        if rX > f.xSize or rY > f.ySize:
-          inFeat = inLayer.GetNextFeature()
-          continue
-        value = float(band[ rY, rX ])   ##needed for ogr 1.8
-        inFeat.SetField( shortName, value )
-        if inLayer.SetFeature( inFeat ) != 0:
-          print 'Failed to update feature.'
-          sys.exit( 1 )
-        inFeat = inLayer.GetNextFeature()
+      values = sampleBand( ds.GetRasterBand( 1 ), rX, rY, inside, sampleMode )
+      fieldValues.append( ( shortName, values, inside ) )
     else:
       shortName = f.fileBaseName[ -8: ]    #must also be edited in def createFields; orig first 8 characters (:8)
       for b in range( f.bands ):
+        i += 1
+        pb.update( i )
         rband = ds.GetRasterBand( b + 1 )
-        band = rband.ReadAsArray()
-        inLayer.ResetReading()
-        inFeat = inLayer.GetNextFeature()
-        while inFeat is not None:
-          i += 1
-          pb.update( i )
-          geom = inFeat.GetGeometryRef()
-          x = geom.GetX()
-          y = geom.GetY()
-          if needTransform:
-            res = coordTransform.TransformPoint( x, y, 0 )
-            x = res[ 0 ]
-            y = res[ 1 ]
-          rX, rY = mapToPixel( x, y, gt )
-          if rX > f.xSize or rY > f.ySize:
-            inFeat = inLayer.GetNextFeature()
-            continue
-          value = band[ rY, rX ]
-          inFeat.SetField( shortName + '_' + str( b + 1 ), value )
-          if inLayer.SetFeature( inFeat ) != 0:
-            print 'Failed to update feature.'
-            sys.exit( 1 )
-
-          inFeat = inLayer.GetNextFeature()
+        values = sampleBand( rband, rX, rY, inside, sampleMode )
+        fieldValues.append( ( shortName + '_' + str( b + 1 ), values, inside ) )
         rband = None
     ds = None
 
+  # write all the values of each feature with a single update (points outside a raster are left empty)
+  for n, fid in enumerate( fids ):
+    i += 1
+    pb.update( i )
+    inFeat = inLayer.GetFeature( fid )
+    for fieldName, values, inside in fieldValues:
+      if inside[ n ]:
+        inFeat.SetField( fieldName, float( values[ n ] ) )   ##float needed for ogr 1.8
+    if inLayer.SetFeature( inFeat ) != 0:
+      print 'Failed to update feature.'
+      sys.exit( 1 )
+
   print '\n'
   print 'Completed in', time.time() - start, 'sec.'
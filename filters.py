@@ -10,65 +10,281 @@ opening an image removes noise
 closing an image connects lines/points that are disjointed
     erosion removes single pixels surrounded by a different value
     dilation enlarges large areas ("smooths" edges)
+a sequence of filters (e.g. open, close, then sieve away small patches) can be applied in one pass with filter_sequence,
+    which only writes the final product
 
 
 NOTES:
-must manually edit filter window size
-deals only with integer values (must edit if want to filter floats)
+large rasters can be filtered in windows (tileMB) on several threads (workers); windows overlap by kernel_halo pixels
+    so the result is the same as filtering the whole image (pixels outside the image are ignored, the cv2 default)
+kernel size and shape are set with size and shape (see make_kernel); large rectangular kernels use van Herk/Gil-Werman
+the output has the data type (and nodata value) of the input, so floats and uint16 can be filtered too;
+    nodata pixels (see raster.nodata_mask) are left out of the filters and stay nodata
 """
 
+import os
+import uuid
 from osgeo import gdal
 import numpy as np
+from multiprocessing.pool import ThreadPool
 import cv2
+import raster
 
-##currently doesn't address boundaries (simply uses defaults)
-##watch for filter window size and integer values (vs floats)
-#applies an opening filter (erosion followed by dilation) to reduce noise
-def openraster (infile):
+#cv2 structuring element shapes by name
+SHAPES = {'rect': cv2.MORPH_RECT, 'disk': cv2.MORPH_ELLIPSE, 'cross': cv2.MORPH_CROSS}
+#rectangular kernels at least this wide are filtered with van Herk/Gil-Werman (cost independent of the kernel size)
+    #instead of cv2 (cost grows with the kernel size)
+VHGW_MIN = 9
+#filter_sequence operations: (cv2 operation or None for gdal.SieveFilter, output name suffix)
+OPERATIONS = {'open': (cv2.MORPH_OPEN, '_opened'), 'close': (cv2.MORPH_CLOSE, '_closed'),
+              'erode': (cv2.MORPH_ERODE, '_eroded'), 'dilate': (cv2.MORPH_DILATE, '_dilated'),
+              'sieve': (None, '_sieved')}
+#default minimum polygon size (pixels) kept by a sieve
+SIEVE_THRESHOLD = 4
+
+#returns a size x size structuring element (np.uint8 array of 0/1) of the given shape (rect, disk or cross)
+def make_kernel (size=3, shape='rect'):
+    if shape not in SHAPES:
+        raise ValueError('Unknown kernel shape ' + str(shape) + ' (use ' + ', '.join(sorted(SHAPES)) + ')')
+    return cv2.getStructuringElement(SHAPES[shape], (size, size))
+
+
+#number of pixels around a window needed to open/close it exactly as part of the whole image
+    #(erosion then dilation each reach one kernel radius)
+def kernel_halo (kernel):
+    return 2 * (max(kernel.shape) // 2)
+
+
+#averaging window
+KERNEL = make_kernel(3)
+#erosions (np.minimum) and dilations (np.maximum) making up each morphological operation, in order
+MORPH_STEPS = {cv2.MORPH_ERODE: (np.minimum,), cv2.MORPH_DILATE: (np.maximum,),
+               cv2.MORPH_OPEN: (np.minimum, np.maximum), cv2.MORPH_CLOSE: (np.maximum, np.minimum)}
+
+#sliding minimum/maximum (func = np.minimum or np.maximum) of width k along the last axis of an array
+    #(van Herk/Gil-Werman: 3 comparisons per pixel whatever k; the window of pixel i is [i - k//2, i - k//2 + k - 1],
+    #the cv2 anchor, and pixels outside the array are ignored by padding with fill)
+def vhgw_1d (array, k, func, fill):
+    n = array.shape[-1]
+    total = -(-(n + k - 1) // k) * k
+    padded = np.empty(array.shape[:-1] + (total,), array.dtype)
+    padded.fill(fill)
+    padded[..., k // 2:k // 2 + n] = array
+    blocks = padded.reshape(array.shape[:-1] + (total // k, k))
+    #running min/max from the start (g) and from the end (h) of each block of k pixels
+    g = func.accumulate(blocks, axis=-1).reshape(padded.shape)
+    h = func.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1].reshape(padded.shape)
+    return func(h[..., :n], g[..., k - 1:k - 1 + n])
+
+
+#value of a data type that an erosion (func = np.minimum) or dilation (np.maximum) never picks over another value:
+    #the highest value of the type for an erosion, the lowest for a dilation (infinity for floats)
+def neutral_value (dtype, func):
+    if dtype.kind == 'f':
+        lowest, highest = -np.inf, np.inf
+    else:
+        lowest, highest = np.iinfo(dtype).min, np.iinfo(dtype).max
+    return highest if func is np.minimum else lowest
+
+
+#erodes (np.minimum) or dilates (np.maximum) a 2D array with a rectangular kernel (rows then columns)
+def vhgw_2d (array, shape, func):
+    fill = neutral_value(array.dtype, func)
+    rows, cols = shape
+    array = vhgw_1d(array, cols, func, fill)
+    return vhgw_1d(array.T, rows, func, fill).T
+
+
+#applies a morphological operation (cv2.MORPH_OPEN, MORPH_CLOSE, MORPH_ERODE or MORPH_DILATE) to an array
+    #(np.uint8, np.uint16, np.int16, np.float32 or np.float64) with the given kernel (default KERNEL)
+    #is_nodata (optional, see raster.nodata_mask) flags pixels left out of the operation: they are set to the neutral_value
+    #of every erosion/dilation, so they never spread into valid pixels, and keep their input value in the output
+def morph_array (array, op, kernel=None, is_nodata=None):
+    if kernel is None:
+        kernel = KERNEL
+    vhgw = min(kernel.shape) >= VHGW_MIN and kernel.all()
+    if is_nodata is None and not vhgw:
+        return cv2.morphologyEx(array, op, kernel)
+
+    original = array
+    for func in MORPH_STEPS[op]:
+        if is_nodata is not None:
+            array = array.copy()
+            array[is_nodata] = neutral_value(array.dtype, func)
+        if vhgw:
+            array = vhgw_2d(array, kernel.shape, func)
+        elif func is np.minimum:
+            array = cv2.erode(array, kernel)
+        else:
+            array = cv2.dilate(array, kernel)
+    array = np.ascontiguousarray(array)
+    if is_nodata is not None:
+        array[is_nodata] = original[is_nodata]
+    return array
+
+
+#returns a window grown by halo pixels on each side (clipped to the raster), and where the
+    #original window sits inside it: (x0, y0, xsize, ysize), (xoff, yoff)
+def halo_window (window, halo, xsize, ysize):
+    xoff, yoff, wx, wy = window
+    x0 = max(xoff - halo, 0)
+    y0 = max(yoff - halo, 0)
+    x1 = min(xoff + wx + halo, xsize)
+    y1 = min(yoff + wy + halo, ysize)
+    return (x0, y0, x1 - x0, y1 - y0), (xoff - x0, yoff - y0)
+
+
+#applies a series of morphological operations (steps: list of (op, kernel)) to a raster file in one read/write pass
+    #and writes the result to outfile; intermediates (optional) is a list of file names for the result of every step but the last
+    #tileMB=None filters the whole image at once; otherwise the image is filtered in windows (see raster.block_windows)
+    #read with a margin of the summed kernel_halo of the steps, so the output is identical to the whole-image result
+    #windows are filtered on a pool of workers threads (cv2 releases the GIL); reading and writing stay in this thread
+    #the outputs have the data type and nodata value of the input (nodata pixels are left out and stay nodata); profile (for outfile) and intermediate_profile
+    #override the current output profile (see raster.set_output_profile)
+def morph_steps (infile, outfile, steps, tileMB=None, workers=1, intermediates=None, profile=None, intermediate_profile=None):
+    halo = sum(kernel_halo(kernel) for op, kernel in steps)
     infile_open = gdal.Open(infile)
-    infile_array = infile_open.GetRasterBand(1).ReadAsArray()  
-    #averaging window    
-    kernel = np.ones((3,3),np.uint8)
-    
-    #open image (erode, then dilate)
-    outfile_array = cv2.morphologyEx(infile_array, cv2.MORPH_OPEN, kernel)
-    
-    #create new GeoTiff, apply georef info, and write new raster
-    outfile = infile[:-4] + '_opened.tif'    
-    geo = infile_open.GetGeoTransform()
-    outfile_open = gdal.GetDriverByName('GTiff').Create(outfile, infile_array.shape[1], infile_array.shape[0], 1, gdal.GDT_Byte)
-    outfile_open.SetGeoTransform((geo[0], geo[1], geo[2], geo[3], geo[4], geo[5]))
-    outfile_open.SetProjection(infile_open.GetProjection())
-    outfile_open.GetRasterBand(1).WriteArray(outfile_array)    
-    
+    inband = infile_open.GetRasterBand(1)
+    xsize = inband.XSize
+    ysize = inband.YSize
+    outfiles = list(intermediates or []) + [outfile]
+    profiles = [intermediate_profile] * (len(outfiles) - 1) + [profile]
+    outfile_opens = [raster.create_rasterfile(infile, name, inband.DataType, inband.GetNoDataValue(), name_profile)
+                     for name, name_profile in zip(outfiles, profiles)]
+    outbands = [outfile_open.GetRasterBand(1) for outfile_open in outfile_opens]
+
+    #filter one window: (window, array read with its halo, its nodata pixels, offset of the window in the array)
+        #returns the window of the result of each step that is written (all steps with intermediates, else the last)
+    def filter_window (job):
+        (xoff, yoff, wx, wy), array, is_nodata, (dx, dy) = job
+        results = []
+        for op, kernel in steps:
+            array = morph_array(array, op, kernel, is_nodata)
+            results.append(array[dy:dy + wy, dx:dx + wx])
+        return results[-len(outbands):]
+
+    windows = list(raster.block_windows(inband, tileMB, gdal.GetDataTypeSize(inband.DataType) // 8))
+    pool = ThreadPool(workers) if workers > 1 and len(windows) > 1 else None
+    #only workers windows are held in memory at a time
+    batch = max(workers, 1)
+    for i in range(0, len(windows), batch):
+        jobs = []
+        for window in windows[i:i + batch]:
+            (x0, y0, wx, wy), offset = halo_window(window, halo, xsize, ysize)
+            array = inband.ReadAsArray(x0, y0, wx, wy)
+            jobs.append((window, array, raster.nodata_mask(inband, array, x0, y0), offset))
+        results = pool.map(filter_window, jobs) if pool is not None else [filter_window(job) for job in jobs]
+        for job, arrays in zip(jobs, results):
+            for outband, array in zip(outbands, arrays):
+                outband.WriteArray(array, job[0][0], job[0][1])
+
+    if pool is not None:
+        pool.close()
+        pool.join()
     infile_open = None
-    outfile_open = None
-    
+    outbands = None
+    outfile_opens = [raster.close_rasterfile(outfile_open) for outfile_open in outfile_opens]
+
     return outfile
-    
-    
-##currently doesn't address boundaries (simply uses defaults)
-##watch for filter window size and integer values (vs floats)
-#applies a closing filter (dilation followed by erosion) to reduce noise
-def closeraster (infile):
+
+
+#applies a morphological operation to a raster file and writes the result to outfile
+    #kernel defaults to KERNEL (tileMB and workers: see morph_steps)
+def morph_raster (infile, outfile, op, tileMB=None, workers=1, kernel=None):
+    if kernel is None:
+        kernel = KERNEL
+    return morph_steps(infile, outfile, [(op, kernel)], tileMB, workers)
+
+
+#removes raster polygons (connected areas of the same value) smaller than threshold pixels from a raster file
+    #with gdal.SieveFilter and writes the result to outfile (connectedness 4 or 8); nodata pixels are left out
+    #profile overrides the current output profile
+def sieveraster (infile, outfile, threshold, connectedness=4, profile=None):
     infile_open = gdal.Open(infile)
-    infile_array = infile_open.GetRasterBand(1).ReadAsArray()  
-    #averaging window    
-    kernel = np.ones((3,3),np.uint8)
-    
-    #close image (dilate, then erod)
-    outfile_array = cv2.morphologyEx(infile_array, cv2.MORPH_CLOSE, kernel)
-    
-    #create new GeoTiff, apply georef info, and write new raster
-    outfile = infile[:-4] + '_closed.tif'    
-    geo = infile_open.GetGeoTransform()
-    outfile_open = gdal.GetDriverByName('GTiff').Create(outfile, infile_array.shape[1], infile_array.shape[0], 1, gdal.GDT_Byte)
-    outfile_open.SetGeoTransform((geo[0], geo[1], geo[2], geo[3], geo[4], geo[5]))
-    outfile_open.SetProjection(infile_open.GetProjection())
-    outfile_open.GetRasterBand(1).WriteArray(outfile_array)    
-    
+    inband = infile_open.GetRasterBand(1)
+    outfile_open = raster.create_rasterfile(infile, outfile, inband.DataType, inband.GetNoDataValue(), profile)
+    gdal.SieveFilter(inband, inband.GetMaskBand(), outfile_open.GetRasterBand(1), threshold, connectedness)
+
     infile_open = None
-    outfile_open = None
-    
+    outfile_open = raster.close_rasterfile(outfile_open)
+    return outfile
+
+
+#applies a sequence of operations to a raster file, writing only the final product (unless keep_intermediates)
+    #ops is an ordered list of 'open', 'close', 'erode', 'dilate' or 'sieve', or of tuples
+    #(name, size[, shape]) for the morphological operations (see make_kernel) and ('sieve', threshold[, connectedness])
+    #consecutive morphological operations run in one read/write pass (see morph_steps); a sieve needs the whole
+    #result of the operations before it, so operations after a sieve start a new pass (from an in-memory /vsimem/ file)
+    #outfile defaults to the input name plus a suffix for every operation (e.g. _opened_closed_sieved.tif)
+    #keep_intermediates also writes the result of every operation but the last, with the suffixes up to it
+def filter_sequence (infile, ops, outfile=None, keep_intermediates=False, tileMB=None, workers=1):
+    steps = []
+    names = []
+    name = infile[:-4]
+    for op in ops:
+        if not isinstance(op, tuple):
+            op = (op,)
+        if op[0] not in OPERATIONS:
+            raise ValueError('Unknown filter operation ' + str(op[0]) + ' (use ' + ', '.join(sorted(OPERATIONS)) + ')')
+        code, suffix = OPERATIONS[op[0]]
+        if code is None:
+            threshold = op[1] if len(op) > 1 else SIEVE_THRESHOLD
+            connectedness = op[2] if len(op) > 2 else 4
+            steps.append((None, (threshold, connectedness)))
+        else:
+            steps.append((code, make_kernel(*op[1:])))
+        name = name + suffix
+        names.append(name + '.tif')
+    if outfile is None:
+        outfile = names[-1]
+    #file written by each step: intermediates are kept under their names or held in memory under a unique name
+        #(so calls on files with the same name, or running at the same time, never share one)
+    targets = [names[i] if keep_intermediates else '/vsimem/' + uuid.uuid4().hex + '_' + os.path.basename(names[i])
+               for i in range(len(steps))]
+    targets[-1] = outfile
+    #intermediates are read again right away, so they are never written as COG
+        #(kept ones use the current profile, or deflate instead of cog; in-memory ones are left uncompressed)
+    if not keep_intermediates:
+        intermediate_profile = 'default'
+    elif raster.output_profile['name'] == 'cog':
+        intermediate_profile = 'deflate'
+    else:
+        intermediate_profile = None
+    profiles = [intermediate_profile] * (len(steps) - 1) + [None]
+
+    current = infile
+    i = 0
+    while i < len(steps):
+        if steps[i][0] is None:
+            j = i + 1
+            threshold, connectedness = steps[i][1]
+            sieveraster(current, targets[i], threshold, connectedness, profiles[i])
+        else:
+            j = i
+            while j < len(steps) and steps[j][0] is not None:
+                j += 1
+            intermediates = targets[i:j - 1] if keep_intermediates else None
+            morph_steps(current, targets[j - 1], steps[i:j], tileMB, workers, intermediates,
+                        profiles[j - 1], intermediate_profile)
+        if current != infile and current.startswith('/vsimem/'):
+            raster.unlink_raster(current)
+        current = targets[j - 1]
+        i = j
+
     return outfile
 
+
+#applies an opening filter (erosion followed by dilation) to reduce noise
+    #with a size x size kernel of the given shape (see make_kernel; tileMB and workers: see morph_raster)
+def openraster (infile, tileMB=None, workers=1, size=3, shape='rect'):
+    #open image (erode, then dilate)
+    outfile = infile[:-4] + '_opened.tif'
+    return morph_raster(infile, outfile, cv2.MORPH_OPEN, tileMB, workers, make_kernel(size, shape))
+    
+    
+#applies a closing filter (dilation followed by erosion) to reduce noise
+    #with a size x size kernel of the given shape (see make_kernel; tileMB and workers: see morph_raster)
+def closeraster (infile, tileMB=None, workers=1, size=3, shape='rect'):
+    #close image (dilate, then erode)
+    outfile = infile[:-4] + '_closed.tif'
+    return morph_raster(infile, outfile, cv2.MORPH_CLOSE, tileMB, workers, make_kernel(size, shape))
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+DESCRIPTION:
+builds and queries a persistent (SQLite) index of Landsat scene metadata so that an archive of
+_MTL.txt files only has to be parsed once; scenes can then be selected by spacecraft, date,
+month and sun elevation without opening the text files again
+
+FUNCTIONS:
+    parse _MTL.txt files into the index, skipping files that have not changed since they were indexed (buildIndex)
+    select scenes matching a set of criteria (queryScenes)
+    get the per-band calibration constants and file names of a scene (sceneBands)
+    get the full metadata dictionary of a scene, as returned by Landsat_TOARefl.readMetadata (loadMetadata)
+    find the _MTL.txt files given directly or in directories (findMetadataFiles, also used by Landsat_TOARefl_batch)
+
+SYNTAX:
+python full_path_to_script/metadata_index.py build index_file [directories and/or _MTL.txt files...]
+python full_path_to_script/metadata_index.py query index_file [--spacecraft LANDSAT_8] [--minsun 30] [--maxsun 90] [--months 3,4] [--start YYYY-MM-DD] [--end YYYY-MM-DD]
+    directories are searched recursively for files ending in _MTL.txt
+
+NOTES:
+both metadata naming schemes (e.g. RADIANCE_MAXIMUM_BAND_1 and LMAX_BAND1) are stored under the same band columns
+"""
+
+import sys, os
+import sqlite3
+import Landsat_TOARefl as toa
+
+#band columns and the metadata key patterns (new format, old format) they are read from
+BAND_FIELDS = [('file_name', 'FILE_NAME_BAND_%s', 'BAND%s_FILE_NAME'),
+               ('lmax', 'RADIANCE_MAXIMUM_BAND_%s', 'LMAX_BAND%s'),
+               ('lmin', 'RADIANCE_MINIMUM_BAND_%s', 'LMIN_BAND%s'),
+               ('qcalmax', 'QUANTIZE_CAL_MAX_BAND_%s', 'QCALMAX_BAND%s'),
+               ('qcalmin', 'QUANTIZE_CAL_MIN_BAND_%s', 'QCALMIN_BAND%s'),
+               ('refl_mult', 'REFLECTANCE_MULT_BAND_%s', None),
+               ('refl_add', 'REFLECTANCE_ADD_BAND_%s', None),
+               ('rad_mult', 'RADIANCE_MULT_BAND_%s', None),
+               ('rad_add', 'RADIANCE_ADD_BAND_%s', None),
+               ('k1', 'K1_CONSTANT_BAND_%s', None),
+               ('k2', 'K2_CONSTANT_BAND_%s', None)]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (id INTEGER PRIMARY KEY, mtl TEXT UNIQUE, mtime REAL, spacecraft TEXT,
+    date TEXT, doy INTEGER, month INTEGER, sun_elevation REAL, sun_azimuth REAL, cloud_cover REAL);
+CREATE TABLE IF NOT EXISTS bands (scene_id INTEGER, band TEXT, file_name TEXT, lmax REAL, lmin REAL,
+    qcalmax REAL, qcalmin REAL, refl_mult REAL, refl_add REAL, rad_mult REAL, rad_add REAL, k1 REAL, k2 REAL);
+CREATE TABLE IF NOT EXISTS metadata (scene_id INTEGER, key TEXT, value TEXT);
+CREATE INDEX IF NOT EXISTS scenes_select ON scenes (spacecraft, month, sun_elevation);
+CREATE INDEX IF NOT EXISTS bands_scene ON bands (scene_id);
+CREATE INDEX IF NOT EXISTS metadata_scene ON metadata (scene_id);
+"""
+
+##########  Functions  ##########
+#opens (and creates if needed) the index database
+def openIndex(index):
+    conn = sqlite3.connect(index)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+#converts a metadata value to a float (None if missing or not a number)
+def _float(metadata, key):
+    try:
+        return float(metadata[key])
+    except (KeyError, ValueError):
+        return None
+
+
+#finds the band identifiers (e.g. '1', '6_VCID_2', '10') present in a metadata dictionary
+def _metadataBands(metadata):
+    bands = set()
+    for key in metadata.keys():
+        if key.startswith('FILE_NAME_BAND_'):
+            bands.add(key[len('FILE_NAME_BAND_'):])
+        elif key.startswith('BAND') and key.endswith('_FILE_NAME'):
+            bands.add(key[len('BAND'):-len('_FILE_NAME')])
+    return sorted(bands)
+
+
+#returns a sorted list of the _MTL.txt files given directly or found (recursively) in the given directories
+def findMetadataFiles(inputs):
+    mtlFiles = []
+    for name in inputs:
+        if os.path.isdir(name):
+            for root, dirs, files in os.walk(name):
+                for f in files:
+                    if f.endswith('_MTL.txt'):
+                        mtlFiles.append(os.path.join(root, f))
+        else:
+            mtlFiles.append(name)
+
+    return sorted(set(os.path.abspath(f) for f in mtlFiles))
+
+
+#parses the given _MTL.txt files (or the ones found in the given directories) into the index
+    #files already indexed with the same modification time are skipped; returns the number of files (re)indexed
+def buildIndex(index, inputs):
+    conn = openIndex(index)
+    indexed = dict(conn.execute('SELECT mtl, mtime FROM scenes').fetchall())
+    count = 0
+
+    for mtl in findMetadataFiles(inputs):
+        mtime = os.path.getmtime(mtl)
+        if indexed.get(mtl) == mtime:
+            continue
+
+        metadataFile = open(mtl)
+        metadata = toa.readMetadata(metadataFile)
+        metadataFile.close()
+
+        date = metadata.get('DATE_ACQUIRED', metadata.get('ACQUISITION_DATE'))
+        doy = toa.calcDOY(date) if date else None
+        month = int(date.split('-')[1]) if date else None
+
+        old = conn.execute('SELECT id FROM scenes WHERE mtl = ?', (mtl,)).fetchone()
+        if old:
+            for table in ('bands', 'metadata'):
+                conn.execute('DELETE FROM ' + table + ' WHERE scene_id = ?', old)
+            conn.execute('DELETE FROM scenes WHERE id = ?', old)
+
+        cur = conn.execute('INSERT INTO scenes (mtl, mtime, spacecraft, date, doy, month, sun_elevation, sun_azimuth, cloud_cover) VALUES (?,?,?,?,?,?,?,?,?)',
+                           (mtl, mtime, metadata.get('SPACECRAFT_ID'), date, doy, month,
+                            _float(metadata, 'SUN_ELEVATION'), _float(metadata, 'SUN_AZIMUTH'), _float(metadata, 'CLOUD_COVER')))
+        scene_id = cur.lastrowid
+
+        for band in _metadataBands(metadata):
+            row = [scene_id, band]
+            for column, newKey, oldKey in BAND_FIELDS:
+                key = newKey % band
+                if key not in metadata and oldKey is not None:
+                    key = oldKey % band
+                if column == 'file_name':
+                    row.append(metadata.get(key))
+                else:
+                    row.append(_float(metadata, key))
+            conn.execute('INSERT INTO bands VALUES (' + ','.join(['?'] * len(row)) + ')', row)
+
+        conn.executemany('INSERT INTO metadata VALUES (?,?,?)', [(scene_id, k, v) for k, v in metadata.items()])
+        count += 1
+
+    conn.commit()
+    conn.close()
+    return count
+
+
+#returns a list of dictionaries (mtl, spacecraft, date, doy, sun_elevation, sun_azimuth, cloud_cover) for the indexed scenes matching all given criteria
+    #months is a list of month numbers; startDate/endDate are inclusive YYYY-MM-DD strings
+def queryScenes(index, spacecraft=None, minSunElevation=None, maxSunElevation=None, months=None, startDate=None, endDate=None):
+    where = []
+    params = []
+    if spacecraft is not None:
+        where.append('spacecraft = ?')
+        params.append(spacecraft)
+    if minSunElevation is not None:
+        where.append('sun_elevation > ?')
+        params.append(float(minSunElevation))
+    if maxSunElevation is not None:
+        where.append('sun_elevation <= ?')
+        params.append(float(maxSunElevation))
+    if months:
+        where.append('month IN (' + ','.join(['?'] * len(months)) + ')')
+        params.extend([int(m) for m in months])
+    if startDate is not None:
+        where.append('date >= ?')
+        params.append(startDate)
+    if endDate is not None:
+        where.append('date <= ?')
+        params.append(endDate)
+
+    columns = ['mtl', 'spacecraft', 'date', 'doy', 'sun_elevation', 'sun_azimuth', 'cloud_cover']
+    sql = 'SELECT ' + ', '.join(columns) + ' FROM scenes'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY date, mtl'
+
+    conn = openIndex(index)
+    scenes = [dict(zip(columns, row)) for row in conn.execute(sql, params)]
+    conn.close()
+    return scenes
+
+
+#returns a dictionary of band identifier: dictionary of calibration constants and file name for an indexed scene
+def sceneBands(index, mtl):
+    columns = [field[0] for field in BAND_FIELDS]
+    conn = openIndex(index)
+    rows = conn.execute('SELECT band, ' + ', '.join(columns) + ' FROM bands JOIN scenes ON bands.scene_id = scenes.id WHERE scenes.mtl = ?',
+                        (os.path.abspath(mtl),)).fetchall()
+    conn.close()
+    return dict((row[0], dict(zip(columns, row[1:]))) for row in rows)
+
+
+#returns the metadata dictionary of an indexed scene (same contents as Landsat_TOARefl.readMetadata), or None if the scene
+    #is not indexed or its _MTL.txt file changed since it was indexed
+def loadMetadata(index, mtl):
+    mtl = os.path.abspath(mtl)
+    conn = openIndex(index)
+    row = conn.execute('SELECT id, mtime FROM scenes WHERE mtl = ?', (mtl,)).fetchone()
+    metadata = None
+    if row and os.path.exists(mtl) and os.path.getmtime(mtl) == row[1]:
+        metadata = dict(conn.execute('SELECT key, value FROM metadata WHERE scene_id = ?', (row[0],)).fetchall())
+    conn.close()
+    return metadata
+
+
+#////////////////////////////////////MAIN LOOP///////////////////////////////////////
+if __name__ == "__main__":
+    args, options = toa.splitOptions(sys.argv)
+    command = args[1]
+    index = args[2]
+
+    if command == 'build':
+        count = buildIndex(index, args[3:])
+        print str(count) + ' metadata files indexed'
+
+    elif command == 'query':
+        months = options['months'].split(',') if 'months' in options else None
+        scenes = queryScenes(index, options.get('spacecraft'), options.get('minsun'), options.get('maxsun'),
+                             months, options.get('start'), options.get('end'))
+        for scene in scenes:
+            print scene['mtl']
+
+    else:
+        print 'Unknown command ' + command + ' (use build or query)'
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+DESCRIPTION:
+lazy raster processing chains: each step (trim, band math, filter) is a node that computes any window
+of its output on request from the windows of its inputs, so a chain such as
+    trim_raster -> classify_NDSI -> openraster -> closeraster
+only writes the final product (block by block) instead of a full GeoTiff per step
+
+FUNCTIONS/CLASSES:
+    Source (a band of a raster file or open dataset), Trim (trim_raster as an in-memory warped VRT),
+    BandMath (any band_math expression), NDSI and TwobAvg (band_math), Morph (filters open/close)
+    write the output of a node to a raster file, block by block (materialize)
+    read the whole output of a node into an array (to_array)
+
+EXAMPLE:
+    green = Trim(green_file, roi_shp, 30)
+    swir = Trim(swir_file, roi_shp, 30)
+    snow = Morph(Morph(NDSI(green, swir, 0.4), cv2.MORPH_OPEN), cv2.MORPH_CLOSE)
+    materialize(snow, 'snow_opened_closed.tif', tileMB=64)
+
+NOTES:
+every input of a node must be on the same grid (e.g. trimmed to the same shapefile with the same pixel size)
+"""
+
+import abc
+from osgeo import gdal, gdal_array
+import numpy as np
+import raster
+import band_math
+import filters
+
+##########  Nodes  ##########
+#abstract base class: a node has the grid (template, a RasterTemplate), GDAL data type (dtype) and nodata value of its output
+    #and computes any window of it with read(xoff, yoff, xsize, ysize); subclasses set these attributes and define read
+class Node(object):
+    __metaclass__ = abc.ABCMeta
+
+    #returns the (ysize, xsize) array of the window of this node's output
+    @abc.abstractmethod
+    def read(self, xoff, yoff, xsize, ysize):
+        pass
+
+    #nodata pixels of a window of this node's output
+    def nodata_mask(self, array, xoff, yoff):
+        if self.nodata is None:
+            return None
+        return (array == self.nodata)
+
+
+#a band of a raster file (filename) or open gdal dataset
+class Source(Node):
+    def __init__(self, infile, band=1):
+        if isinstance(infile, gdal.Dataset):
+            self.ds = infile
+        else:
+            self.ds = gdal.Open(infile)
+        self.band = self.ds.GetRasterBand(band)
+        self.template = raster.get_template(self.ds)
+        self.dtype = self.band.DataType
+        self.nodata = self.band.GetNoDataValue()
+
+    def read(self, xoff, yoff, xsize, ysize):
+        return self.band.ReadAsArray(xoff, yoff, xsize, ysize)
+
+    def nodata_mask(self, array, xoff, yoff):
+        return raster.nodata_mask(self.band, array, xoff, yoff)
+
+
+#raster.trim_raster kept as an in-memory warped VRT (pixels are only warped when a window is read)
+class Trim(Source):
+    def __init__(self, infile, mask, pxsz):
+        Source.__init__(self, raster.trim_raster(infile, mask, '', pxsz, format='VRT', as_dataset=True))
+
+
+#wraps filenames/datasets (band 1) or (filename, band number) tuples given as node inputs in a Source
+def as_node(node):
+    if isinstance(node, Node):
+        return node
+    if isinstance(node, tuple):
+        return Source(*node)
+    return Source(node)
+
+
+#a band math expression (string or band_math.Expression) over named inputs as a node (see band_math.calc_expression)
+    #inputs is a dictionary of name: node, filename, (filename, band number) tuple or number
+class BandMath(Node):
+    def __init__(self, expression, inputs, NODATA=-99, dtype=gdal.GDT_Float32):
+        self.expression = band_math.as_expression(expression)
+        rasters, self.constants = band_math.split_inputs(self.expression, inputs)
+        self.inputs = [(name, as_node(node)) for name, node in rasters]
+        self.template = self.inputs[0][1].template
+        self.dtype = dtype
+        self.nodata = NODATA
+
+    def read(self, xoff, yoff, xsize, ysize):
+        env = dict(self.constants)
+        masks = []
+        for name, node in self.inputs:
+            array = node.read(xoff, yoff, xsize, ysize)
+            masks.append(node.nodata_mask(array, xoff, yoff))
+            env[name] = array.astype(np.float32, copy=False)
+        return self.expression.apply(env, raster.merge_nodata(*masks),
+                                     gdal_array.GDALTypeCodeToNumericTypeCode(self.dtype), self.nodata)
+
+
+#band_math.classify_NDSI as a node
+class NDSI(BandMath):
+    def __init__(self, bandi, bandj, threshold, NODATA=band_math.CLASS_NODATA):
+        BandMath.__init__(self, band_math.NDSI_EXPRESSION, {'bandi': bandi, 'bandj': bandj, 'threshold': threshold},
+                          NODATA, gdal.GDT_Byte)
+
+
+#band_math.classify_twob_avg as a node
+class TwobAvg(BandMath):
+    def __init__(self, bandi, bandj, mask, threshold, NODATA=band_math.CLASS_NODATA):
+        BandMath.__init__(self, band_math.TWOB_AVG_EXPRESSION,
+                          {'bandi': bandi, 'bandj': bandj, 'mask': mask, 'threshold': threshold}, NODATA, gdal.GDT_Byte)
+
+
+#filters.openraster/closeraster (op = cv2.MORPH_OPEN or cv2.MORPH_CLOSE) as a node, with kernel (default filters.KERNEL)
+    #each window is computed from the input window grown by filters.kernel_halo pixels, so it matches the whole-image result
+class Morph(Node):
+    def __init__(self, infile, op, kernel=None):
+        self.infile = as_node(infile)
+        self.op = op
+        self.kernel = filters.KERNEL if kernel is None else kernel
+        self.template = self.infile.template
+        self.dtype = self.infile.dtype
+        self.nodata = self.infile.nodata
+
+    def read(self, xoff, yoff, xsize, ysize):
+        (x0, y0, wx, wy), (dx, dy) = filters.halo_window((xoff, yoff, xsize, ysize), filters.kernel_halo(self.kernel),
+                                                         self.template.xsize, self.template.ysize)
+        array = self.infile.read(x0, y0, wx, wy)
+        #booleans (e.g. from NDSI) are filtered as bytes
+        if array.dtype == np.bool_:
+            array = array.view(np.uint8)
+        array = filters.morph_array(array, self.op, self.kernel, self.infile.nodata_mask(array, x0, y0))
+        return array[dy:dy + ysize, dx:dx + xsize]
+
+    #nodata pixels keep their input value (see filters.morph_array), so they are those of the input
+    def nodata_mask(self, array, xoff, yoff):
+        return self.infile.nodata_mask(array, xoff, yoff)
+
+
+##########  Functions  ##########
+#writes the output of a node to outfile (can be a /vsimem/ path), computing it window by window
+    #(windows follow the output file's blocks and are at most tileMB megabytes; None computes the whole raster at once)
+def materialize(node, outfile, tileMB=None, profile=None):
+    outfile_open = node.template.create(outfile, node.dtype, node.nodata, profile)
+    outband = outfile_open.GetRasterBand(1)
+    for xoff, yoff, xsize, ysize in raster.block_windows(outband, tileMB):
+        outband.WriteArray(node.read(xoff, yoff, xsize, ysize), xoff, yoff)
+
+    outfile_open = raster.close_rasterfile(outfile_open)
+    return outfile
+
+
+#returns the whole output of a node as an array
+def to_array(node):
+    return node.read(0, 0, node.template.xsize, node.template.ysize)
@@ -9,42 +9,406 @@ Perform raster file operations, such as write out a new array to a georeferenced
 rasterfile and trim a raster to a shapefile for faster processing
 
 FUNCTIONS:
+    choose the layout/compression of the output GeoTiffs (set_output_profile, creation_options)
     create a georeferenced raster file using the geospatial info from a parent raster (rasterfile)
-    trim a raster file (along pixel boundaries) to a polygon shapefile extent (trim_raster)
+    create an empty georeferenced raster file to be written in windows (create_rasterfile) and close it (close_rasterfile)
+    describe the grid of a parent raster from its header only, cached per file (RasterTemplate, get_template, forget_template, unlink_raster)
+    open one band of a single or multi-band raster (open_band) and copy a multi-band raster to a .npy memmap (stack_to_npy)
+    split a raster band into block-aligned windows for streaming calculations (block_windows)
+    compute gain * array + bias in float32 without full-size temporaries (scale_array)
+    find the nodata pixels of a band from its nodata value or GDAL mask band (nodata_mask), combine them (merge_nodata) and fill them (set_nodata)
+    trim a raster file (along pixel boundaries) to a polygon shapefile extent, in-process and with cached cutlines (trim_raster, load_cutline, clear_cutlines)
+    trim a raster file to the extent of another raster, as a window copy when the grids already line up (trim_raster2raster, aligned_window)
 
 NOTES:
 trim_raster fn assumes projections match --> ideally this step would include a check and alert/reprojection
+output profiles: 'default' (striped, uncompressed), 'tiled', 'lzw', 'deflate', 'zstd' (tiled + compressed + predictor) and
+    'cog' (deflate + internal overviews in a cloud optimized layout, written when the file is closed with close_rasterfile)
 """
-import os
-from osgeo import gdal
+import os, uuid
+from osgeo import gdal, ogr, osr, gdal_array
+import numpy as np
+
+#GTiff creation options of each output profile ('PREDICTOR': 'auto' picks 3 for floats and 2 for integers)
+OUTPUT_PROFILES = {'default': {},
+                   'tiled': {'TILED': 'YES'},
+                   'lzw': {'TILED': 'YES', 'COMPRESS': 'LZW', 'PREDICTOR': 'auto'},
+                   'deflate': {'TILED': 'YES', 'COMPRESS': 'DEFLATE', 'PREDICTOR': 'auto'},
+                   'zstd': {'TILED': 'YES', 'COMPRESS': 'ZSTD', 'PREDICTOR': 'auto'},
+                   'cog': {'TILED': 'YES', 'COMPRESS': 'DEFLATE', 'PREDICTOR': 'auto'}}
+
+#profile used by every function that writes a GeoTiff (change with set_output_profile)
+output_profile = {'name': 'default', 'blocksize': 256}
+#files created with the 'cog' profile that still have to be converted when they are closed,
+    #by working file name: (final file name, extra creation options of the final file, e.g. INTERLEAVE=BAND)
+pending_cog = {}
+#extra creation options given to RasterTemplate.create that are carried over to the final file of a 'cog' raster
+COG_CARRIED_OPTIONS = ('INTERLEAVE', 'NBITS')
+
+#sets the output profile (see OUTPUT_PROFILES) and the tile size used for tiled profiles
+def set_output_profile (name, blocksize=256):
+    if name not in OUTPUT_PROFILES:
+        raise ValueError('Unknown output profile ' + name + ' (use one of ' + ', '.join(sorted(OUTPUT_PROFILES)) + ')')
+    output_profile['name'] = name
+    output_profile['blocksize'] = int(blocksize)
+
+
+#returns the list of GTiff creation options for the given profile (None = current output profile) and GDAL data type
+def creation_options (dtype, profile=None):
+    if profile is None:
+        profile = output_profile['name']
+    options = []
+    for key, value in sorted(OUTPUT_PROFILES[profile].items()):
+        if key == 'PREDICTOR' and value == 'auto':
+            value = '3' if dtype in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+        options.append(key + '=' + value)
+
+    if 'TILED' in OUTPUT_PROFILES[profile]:
+        options.append('BLOCKXSIZE=' + str(output_profile['blocksize']))
+        options.append('BLOCKYSIZE=' + str(output_profile['blocksize']))
+    if 'COMPRESS' in OUTPUT_PROFILES[profile]:
+        #compressed sizes can't be known in advance, so let GDAL switch to BigTIFF when the file might pass 4GB
+        options.append('BIGTIFF=IF_SAFER')
+        options.append('NUM_THREADS=ALL_CPUS')
+    return options
+
+
+#grid of a raster (size, geo info/proj coord sys, nodata and block layout of band 1), read from the file header only
+class RasterTemplate(object):
+    def __init__(self, ds):
+        band = ds.GetRasterBand(1)
+        self.xsize = ds.RasterXSize
+        self.ysize = ds.RasterYSize
+        self.geotransform = ds.GetGeoTransform()
+        self.projection = ds.GetProjection()
+        self.nodata = band.GetNoDataValue()
+        self.blocksize = band.GetBlockSize()
+        self.dtype = band.DataType
+
+    #creates an empty georeferenced tif raster file on this grid (see create_rasterfile)
+        #options are extra GTiff creation options (e.g. INTERLEAVE=PIXEL for a multi-band stack)
+    def create(self, new_raster_name, dtype, nodata=None, profile=None, bands=1, options=None):
+        geo = self.geotransform
+        creation = creation_options(dtype, profile)
+        #'cog' files are written to a working file and converted to new_raster_name by close_rasterfile
+        if profile == 'cog' or (profile is None and output_profile['name'] == 'cog'):
+            final_name = new_raster_name
+            new_raster_name = new_raster_name[:-4] + '_tmp.tif'
+            pending_cog[new_raster_name] = (final_name, [option for option in (options or [])
+                                                         if option.split('=', 1)[0] in COG_CARRIED_OPTIONS])
+        #the GTiff predictor only works on whole bytes, so it is dropped for bit-packed (NBITS) files
+        if any(option.startswith('NBITS=') for option in (options or [])):
+            creation = [option for option in creation if not option.startswith('PREDICTOR=')]
+        outfile = gdal.GetDriverByName('GTiff').Create(new_raster_name, self.xsize, self.ysize, bands, dtype, creation + (options or []))
+        outfile.SetGeoTransform((geo[0], geo[1], geo[2], geo[3], geo[4], geo[5]))
+        outfile.SetProjection(self.projection)
+        if nodata is not None:
+            for b in range(bands):
+                outfile.GetRasterBand(b + 1).SetNoDataValue(nodata)
+        return outfile
+
+
+#templates already read, by (file name, modification time)
+templates = {}
+
+#returns the RasterTemplate of a parent raster; infile can be a filename (cached, so each file header is read once),
+    #a (filename, band number) tuple, an open gdal dataset or a RasterTemplate (returned as is)
+    #only files on disk are cached: /vsimem/, /vsizip/ or URL names have no modification time to tell a new file apart
+def get_template (infile):
+    if isinstance(infile, RasterTemplate):
+        return infile
+    if isinstance(infile, gdal.Dataset):
+        return RasterTemplate(infile)
+    if isinstance(infile, tuple):
+        infile = infile[0]
+
+    if not os.path.exists(infile):
+        infile_open = gdal.Open(infile)
+        template = RasterTemplate(infile_open)
+        infile_open = None
+        return template
+
+    key = (infile, os.path.getmtime(infile))
+    if key not in templates:
+        infile_open = gdal.Open(infile)
+        templates[key] = RasterTemplate(infile_open)
+        infile_open = None
+    return templates[key]
+
+
+#drops the cached templates of a file (e.g. when it is deleted or rewritten)
+def forget_template (infile):
+    for key in [key for key in templates if key[0] == infile]:
+        del templates[key]
+
+
+#deletes a raster file (or /vsimem/ file) and forgets its template
+def unlink_raster (infile):
+    gdal.Unlink(infile)
+    forget_template(infile)
+
 
 #creates a georeferenced tif raster file with the same dimensions and geo info/proj coord sys as the parent raster. *args[0] is nodata value
+    #(infile can be anything get_template accepts; only its header is read)
 def rasterfile (infile, new_raster_name, new_raster_array, dtype, *args):    
-    #read in original raster (input file) as an array
-    infile_open = gdal.Open(infile)
-    infile_array = infile_open.GetRasterBand(1).ReadAsArray()  
+    if args:
+        nodata = args[0]
+    elif dtype == gdal.GDT_Float32:
+        nodata = -9999
+    else:
+        nodata = None
 
-    #get geo info from original
-    geo = infile_open.GetGeoTransform()
-    
     #create new GeoTiff, apply georef info, and write new raster    
-    outfile = gdal.GetDriverByName('GTiff').Create(new_raster_name, infile_array.shape[1], infile_array.shape[0], 1, dtype)        
-    outfile.SetGeoTransform((geo[0], geo[1], geo[2], geo[3], geo[4], geo[5]))
-    outfile.SetProjection(infile_open.GetProjection())
+    outfile = create_rasterfile(infile, new_raster_name, dtype, nodata)
     outfile.GetRasterBand(1).WriteArray(new_raster_array)
     
-    if args:
-        outfile.GetRasterBand(1).SetNoDataValue(args[0])
-    elif dtype == gdal.GDT_Float32:
-        outfile.GetRasterBand(1).SetNoDataValue(-9999)
-    
-    infile_open = None
-    outfile = None
+    outfile = close_rasterfile(outfile)
     return new_raster_name
+
+
+#creates an empty georeferenced tif raster file with the same dimensions and geo info/proj coord sys as the parent raster
+    #(infile can be anything get_template accepts; only its header is read)
+    #returns the open dataset so it can be written window by window (close it with close_rasterfile when done)
+    #profile overrides the current output profile
+def create_rasterfile (infile, new_raster_name, dtype, nodata=None, profile=None):
+    return get_template(infile).create(new_raster_name, dtype, nodata, profile)
+
+
+#adds an internal (stored in the file itself) per-dataset mask band to a new GTiff and returns it
+    #(0 = nodata, 255 = valid); used where the nodata value cannot be stored in the band, e.g. 1 bit files
+def create_mask_band (outfile):
+    internal = gdal.GetConfigOption('GDAL_TIFF_INTERNAL_MASK')
+    gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', 'YES')
+    outfile.CreateMaskBand(gdal.GMF_PER_DATASET)
+    gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', internal)
+    return outfile.GetRasterBand(1).GetMaskBand()
+
+
+#returns the creation options of the COG driver matching the GTiff options of the 'cog' profile
+    #(BLOCKSIZE instead of TILED/BLOCKXSIZE/BLOCKYSIZE, named predictors, no BIGTIFF)
+def cog_options (dtype):
+    options = []
+    for option in creation_options(dtype, 'cog'):
+        key, value = option.split('=', 1)
+        if key in ('TILED', 'BLOCKYSIZE', 'BIGTIFF'):
+            continue
+        if key == 'BLOCKXSIZE':
+            key = 'BLOCKSIZE'
+        elif key == 'PREDICTOR':
+            value = 'FLOATING_POINT' if value == '3' else 'YES'
+        options.append(key + '=' + value)
+    return options
+
+
+#closes a raster created with create_rasterfile (returns None, so use: outfile = close_rasterfile(outfile))
+    #files created with the 'cog' profile get internal overviews and are copied, from the flushed working file,
+    #to their final name in the cloud optimized layout; the working file is then removed
+    #options (optional) are extra creation options of that copy (e.g. INTERLEAVE=PIXEL for a stack written band interleaved),
+    #replacing the ones given to RasterTemplate.create
+def close_rasterfile (outfile, options=None):
+    name = outfile.GetDescription()
+    if name not in pending_cog:
+        return None
+
+    final_name, extra = pending_cog.pop(name)
+    if options is not None:
+        extra = list(options)
+    dtype = outfile.GetRasterBand(1).DataType
+    resampling = 'AVERAGE' if dtype in (gdal.GDT_Float32, gdal.GDT_Float64) else 'NEAREST'
+
+    #the COG driver (GDAL >= 3.1) builds the overviews itself; otherwise, or if it does not know one of the extra options
+        #(e.g. INTERLEAVE needs GDAL >= 3.11), build them here and copy them in front of the data with GTiff
+    cog_driver = gdal.GetDriverByName('COG')
+    if cog_driver is not None:
+        known = cog_driver.GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+        if not all('name="' + option.split('=', 1)[0] + '"' in known for option in extra):
+            cog_driver = None
+    if cog_driver is None:
+        levels = []
+        size = max(outfile.RasterXSize, outfile.RasterYSize)
+        while size > output_profile['blocksize']:
+            size = size // 2
+            levels.append(2 ** (len(levels) + 1))
+        if levels:
+            outfile.BuildOverviews(resampling, levels)
+    #everything written so far must be in the working file before it is copied
+    outfile.FlushCache()
+
+    if cog_driver is None:
+        creation = creation_options(dtype, 'cog') + ['COPY_SRC_OVERVIEWS=YES']
+    else:
+        creation = cog_options(dtype) + ['OVERVIEW_RESAMPLING=' + resampling]
+    #bit-packed (NBITS) files have no predictor (see RasterTemplate.create)
+    if any(option.startswith('NBITS=') for option in extra):
+        creation = [option for option in creation if not option.startswith('PREDICTOR=')]
+    if cog_driver is None:
+        cog = gdal.Translate(final_name, outfile, creationOptions=creation + extra)
+    else:
+        cog = gdal.Translate(final_name, outfile, format='COG', creationOptions=creation + extra)
+    cog = None
+    forget_template(final_name)
+
+    #close the working file even though the caller still references it (Dataset.Close exists from GDAL 3.8;
+        #older bindings close it when the caller drops its reference) and remove it
+    if hasattr(outfile, 'Close'):
+        outfile.Close()
+    unlink_raster(name)
+    return None
+
+
+#opens a band given as a filename (band 1) or a (filename, band number) tuple, e.g. one band of a multi-band stack
+    #returns the open dataset and the band (keep the dataset referenced while the band is used)
+def open_band (infile):
+    if isinstance(infile, tuple):
+        infile, band = infile
+    else:
+        band = 1
+    infile_open = gdal.Open(infile)
+    return infile_open, infile_open.GetRasterBand(band)
+
+
+#copies a multi-band raster to a .npy file (a numpy memmap sidecar) window by window
+    #interleave 'band' gives an array of shape (bands, rows, cols), 'pixel' one of shape (rows, cols, bands)
+def stack_to_npy (infile, npyfile, interleave='band', tileMB=None):
+    infile_open = gdal.Open(infile)
+    band = infile_open.GetRasterBand(1)
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+    nbands = infile_open.RasterCount
+    if interleave == 'pixel':
+        shape = (infile_open.RasterYSize, infile_open.RasterXSize, nbands)
+    else:
+        shape = (nbands, infile_open.RasterYSize, infile_open.RasterXSize)
+    npy = np.lib.format.open_memmap(npyfile, mode='w+', dtype=dtype, shape=shape)
+
+    for xoff, yoff, xsize, ysize in block_windows(band, tileMB, np.dtype(dtype).itemsize * nbands):
+        array = infile_open.ReadAsArray(xoff, yoff, xsize, ysize).reshape(nbands, ysize, xsize)
+        if interleave == 'pixel':
+            npy[yoff:yoff + ysize, xoff:xoff + xsize, :] = np.rollaxis(array, 0, 3)
+        else:
+            npy[:, yoff:yoff + ysize, xoff:xoff + xsize] = array
+
+    npy.flush()
+    npy = None
+    infile_open = None
+    return npyfile
+
+
+#yields (xoff, yoff, xsize, ysize) windows covering a raster band, aligned to the band's block size (tif strips or tiles)
+    #each window holds at most tileMB megabytes of itemsize-byte pixels (but never less than one block);
+    #if tileMB is None the whole band is returned as a single window
+def block_windows (band, tileMB=None, itemsize=4):
+    xsize = band.XSize
+    ysize = band.YSize
+    if tileMB is None:
+        yield (0, 0, xsize, ysize)
+        return
+
+    blockx, blocky = band.GetBlockSize()
+    budget = max(int(tileMB * 1024 * 1024 / itemsize), blockx * blocky)
+    #use full-width windows (several rows of blocks) when possible, otherwise one row of blocks split into columns
+    if xsize * blocky <= budget:
+        win_x = xsize
+        win_y = (budget // (xsize * blocky)) * blocky
+    else:
+        win_x = (budget // (blockx * blocky)) * blockx
+        win_y = blocky
+
+    for yoff in range(0, ysize, win_y):
+        for xoff in range(0, xsize, win_x):
+            yield (xoff, yoff, min(win_x, xsize - xoff), min(win_y, ysize - yoff))
+
+
+#computes (gain * array) + bias in float32 (whatever the input data type), writing into out if given
+    #(out may be the input array itself if it is already float32)
+def scale_array (array, gain, bias, out=None):
+    if out is None:
+        out = np.empty(array.shape, np.float32)
+    np.multiply(array, np.float32(gain), out=out, casting='unsafe')
+    if bias:
+        np.add(out, np.float32(bias), out=out)
+    return out
+
+
+#returns a boolean array flagging the nodata pixels of an array read from band at (xoff, yoff)
+    #uses the band's nodata value if it has one, otherwise its GDAL mask band (e.g. an internal mask or alpha band) if it has one,
+    #otherwise pixels equal to default (if given); returns None when every pixel is valid
+    #(compute it once from the source band and reuse it for every stage derived from that band)
+def nodata_mask (band, array, xoff=0, yoff=0, default=None):
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        if np.isnan(nodata):
+            return np.isnan(array)
+        return (array == nodata)
+
+    if not band.GetMaskFlags() & gdal.GMF_ALL_VALID:
+        mask = band.GetMaskBand().ReadAsArray(xoff, yoff, array.shape[1], array.shape[0])
+        return (mask == 0)
+
+    if default is not None:
+        return (array == default)
+    return None
+
+
+#combines nodata masks (from nodata_mask, any of which may be None) into one
+    #(the masks given are never modified, so they can be shared between several computations)
+def merge_nodata (*masks):
+    merged = None
+    for mask in masks:
+        if mask is None:
+            continue
+        if merged is None:
+            merged = mask
+        else:
+            merged = merged | mask
+    return merged
+
+
+#sets the pixels flagged in is_nodata (from nodata_mask) to the nodata value, in place
+def set_nodata (array, is_nodata, nodata):
+    if is_nodata is not None:
+        np.copyto(array, nodata, where=is_nodata, casting='unsafe')
+    return array
     
     
+#cutline shapefiles already loaded into memory, by (file name, modification time)
+cutlines = {}
+
+#returns the name of an in-memory (/vsimem/) copy of a cutline shapefile, so clipping many rasters to the same
+    #shapefile only reads it from disk once
+    #each copy (.shp and its sidecar files) gets its own uniquely named /vsimem/ directory; an older copy of a changed
+    #shapefile is removed
+def load_cutline (mask):
+    key = (mask, os.path.getmtime(mask))
+    if key not in cutlines:
+        for old in [k for k in cutlines if k[0] == mask]:
+            unlink_cutline(cutlines.pop(old))
+        mem_name = '/vsimem/cutline_' + uuid.uuid4().hex + '/' + os.path.basename(mask)
+        src = ogr.Open(mask)
+        dst = ogr.GetDriverByName('ESRI Shapefile').CopyDataSource(src, mem_name)
+        src = None
+        dst = None
+        cutlines[key] = mem_name
+    return cutlines[key]
+
+
+#removes an in-memory cutline copy made by load_cutline (the .shp and every sidecar file in its directory)
+def unlink_cutline (mem_name):
+    directory = os.path.dirname(mem_name)
+    for name in gdal.ReadDir(directory) or []:
+        gdal.Unlink(directory + '/' + name)
+
+
+#removes every in-memory cutline copy made by load_cutline and empties the cache
+def clear_cutlines ():
+    for mem_name in cutlines.values():
+        unlink_cutline(mem_name)
+    cutlines.clear()
+
+
 #trims a raster to a shapefile (along pixel boundaries) of the ROI [to reduce polygonizing computation time]
-def trim_raster (infile, mask, outfile, pxsz):
+    #the warp runs in-process: outfile can be a /vsimem/ path, and format='MEM' (with outfile '') or 'VRT' keeps the result in memory;
+    #if as_dataset is True the open (already shifted) dataset is returned instead of outfile (set it to None when done)
+def trim_raster (infile, mask, outfile, pxsz, format='GTiff', as_dataset=False):
     #optional code to get and print projection information (reprojection needs to be added to code)    
     '''
     ds = gdal.Open(infile)
@@ -63,11 +427,15 @@ def trim_raster (infile, mask, outfile, pxsz):
     
 ###could use warp options of gdalwarp to include all touched pixels rather than just pixels with centers in the shapefile    
     #print "Cutting parent raster"
-    cmd = "gdalwarp -tr " + str(pxsz) + " " + str(pxsz) + " -tap -cutline " + mask + " -crop_to_cutline " + infile + " " +  outfile
-    os.system(cmd)
+    #same as: gdalwarp -tr pxsz pxsz -tap -cutline mask -crop_to_cutline infile outfile
+    options = []
+    if format == 'GTiff':
+        options = creation_options(get_template(infile).dtype)
+    ds = gdal.Warp(outfile, infile, format=format, xRes=pxsz, yRes=pxsz, targetAlignedPixels=True,
+                   cutlineDSName=load_cutline(mask), cropToCutline=True, creationOptions=options)
     
-    #translate raster by half a pixel width (in m) so shapefile matches pixel edges rather than pixel centers    
-    ds = gdal.Open(outfile, gdal.GA_Update)
+    #translate raster by half a pixel width (in m) so shapefile matches pixel edges rather than pixel centers
+        #(done on the open output, before it is written out)
     geo = ds.GetGeoTransform()
     #print 'geo0 ', geo[0], ' and geo3 ', geo[3]
     geo_0 = geo[0] + pxsz/2
@@ -78,14 +446,29 @@ def trim_raster (infile, mask, outfile, pxsz):
     
     #geo = ds.GetGeoTransform()
     #print 'geo0 ', geo[0], ' and geo3 ', geo[3]
+    if as_dataset:
+        return ds
     ds = None
     
     return outfile
    
+#returns the value to fill pixels without data with in a raster of GDAL data type dtype: the nodata value of the source
+    #if it has one, else -32768 clipped to the range of the type (0 for unsigned types)
+def fill_value (dtype, nodata=None):
+    if nodata is not None:
+        return nodata
+    numeric = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(dtype))
+    if numeric.kind in 'ui':
+        return max(-32768, np.iinfo(numeric).min)
+    return -32768
+
+
 #trims a raster to the extent of another raster (mask).
 #Note, as written it also uses gdalwarp to resample the image to 2m resolution and a few other flags specific to DEM/bathymetry processing
 #The averaging scheme needs to be changed for DEMs   
-def trim_raster2raster (infile, mask, outfile):
+#If infile is already on a pxsz grid (same projection, no rotation) that lines up with the mask extent, the clip is a plain
+    #pixel window copy (no resampling); otherwise the image is warped
+def trim_raster2raster (infile, mask, outfile, pxsz=2, tileMB=64):
     #optional code to get and print projection information (reprojection needs to be added to code)    
     '''
     ds = gdal.Open(infile)
@@ -115,9 +498,63 @@ def trim_raster2raster (infile, mask, outfile):
     ymin = min(uly,lry)
     xmax = max(ulx,lrx)
     ymax = max(uly,lry)
-    cmd = "gdalwarp -te " + str(xmin) +" "+ str(ymin) +" "+ str(xmax) +" "+ str(ymax) +" "+ "-tr 2 2 -r near -srcnodata -32768 -dstnodata -32768  " + infile +" "+ outfile
-    os.system(cmd)
-    
+    mask_proj = ds_i.GetProjection()
     ds_i = None
-    
-    #return outfile
\ No newline at end of file
+
+    ds = gdal.Open(infile)
+    inband = ds.GetRasterBand(1)
+    dtype = inband.DataType
+    nodata = inband.GetNoDataValue()
+    fill = fill_value(dtype, nodata)
+    window = aligned_window(ds.GetGeoTransform(), ds.GetProjection(), mask_proj, xmin, ymin, xmax, ymax, pxsz)
+    if window is None:
+        #same as: gdalwarp -te xmin ymin xmax ymax -tr 2 2 -r near [-srcnodata nodata] -dstnodata fill infile outfile
+            #(only the source's own nodata value is left out, so valid pixels equal to fill are kept)
+        inband = None
+        ds = None
+        gdal.Warp(outfile, infile, outputBounds=(xmin, ymin, xmax, ymax), xRes=pxsz, yRes=pxsz, resampleAlg='near',
+                  srcNodata=nodata, dstNodata=fill, creationOptions=creation_options(dtype))
+        return outfile
+
+    #grids line up: copy the pixel window, filling whatever falls outside infile with nodata (like gdalwarp -dstnodata)
+    xoff, yoff, xsize, ysize = window
+    outfile_open = gdal.GetDriverByName('GTiff').Create(outfile, xsize, ysize, 1, dtype, creation_options(dtype))
+    outfile_open.SetGeoTransform((xmin, pxsz, 0, ymax, 0, -pxsz))
+    outfile_open.SetProjection(ds.GetProjection())
+    outband = outfile_open.GetRasterBand(1)
+    outband.SetNoDataValue(fill)
+
+    for out_x, out_y, out_xsize, out_ysize in block_windows(outband, tileMB):
+        out_array = np.empty((out_ysize, out_xsize), gdal_array.GDALTypeCodeToNumericTypeCode(dtype))
+        out_array.fill(fill)
+        #part of this window that lies inside infile
+        x0 = max(out_x + xoff, 0)
+        y0 = max(out_y + yoff, 0)
+        x1 = min(out_x + xoff + out_xsize, ds.RasterXSize)
+        y1 = min(out_y + yoff + out_ysize, ds.RasterYSize)
+        if x1 > x0 and y1 > y0:
+            out_array[y0 - out_y - yoff:y1 - out_y - yoff, x0 - out_x - xoff:x1 - out_x - xoff] = inband.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        outband.WriteArray(out_array, out_x, out_y)
+
+    ds = None
+    outfile_open = None
+    return outfile
+
+
+#returns the (xoff, yoff, xsize, ysize) pixel window of a raster (geotransform geo, projection proj) covering the extent
+    #xmin, ymin, xmax, ymax on a pxsz grid, or None if the raster isn't already on that grid (different projection or pixel size,
+    #rotated, or grid origin not a whole number of pixels away); offsets can be negative or run past the raster edge
+def aligned_window (geo, proj, mask_proj, xmin, ymin, xmax, ymax, pxsz, tolerance=1e-6):
+    if proj != mask_proj:
+        srs = osr.SpatialReference(wkt=proj)
+        mask_srs = osr.SpatialReference(wkt=mask_proj)
+        if not srs.IsSame(mask_srs):
+            return None
+    if geo[2] != 0 or geo[4] != 0 or abs(geo[1] - pxsz) > tolerance * pxsz or abs(geo[5] + pxsz) > tolerance * pxsz:
+        return None
+
+    window = [(xmin - geo[0]) / pxsz, (geo[3] - ymax) / pxsz, (xmax - xmin) / pxsz, (ymax - ymin) / pxsz]
+    for x in window:
+        if abs(x - round(x)) > tolerance:
+            return None
+    return tuple(int(round(x)) for x in window)
\ No newline at end of file
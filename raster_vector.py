@@ -10,39 +10,152 @@ Perform raster-vector file operations, including conversions between the two
 FUNCTIONS:
     creates a raster mask with extent of raster file input given a polygon shapefile;
         an attribute value can be specified to provide the raster [burn] value (CreateRasterMask)
+        masks are made in memory and cached (up to MASK_CACHE_MB) by vector file and grid, so they are only rasterized once (clear_mask_cache)
+    creates a raster mask of only the window of the raster file covering the polygons, with its pixel offset (CreateWindowMask)
+        and reads the matching window of a band (ReadWindow)
 
 NOTES:
 
 """
-import os
-from osgeo import gdal, ogr
+import os, math
+from collections import OrderedDict
+from osgeo import gdal, ogr, osr
+import raster
+
+#rasterized masks already made, least recently used first, by (vector file, modification time, burn_val,
+    #.dbf modification time when burning an attribute, dtype, geotransform, size, projection)
+mask_cache = OrderedDict()
+#maximum size (megabytes) of the cached masks; the least recently used ones are dropped beyond it
+MASK_CACHE_MB = 512
 
 # Creates raster mask fitting the input dataset (ds) using the polygon shapefile vector_fn
 # The rasterized mask is named raster_fn
 #note that an output raster file is generated, but the function itself returns the mask array
-def CreateRasterMask(ds, raster_fn, vector_fn, burn_val = ''):
-    # Open vector file and get Layer
+#dtype defaults to Byte for a 0/1 mask and UInt16 when burning an attribute value; nbits=1 writes a 1 bit 0/1 mask
+#the mask is rasterized in memory (MEM) and cached, so masking more bands or scenes on the same grid reuses it
+    #(cache=False always rasterizes again); raster_fn = None (or '') returns the in-memory mask without writing
+    #a file (it is shared through the cache, so do not modify it); raster_fn can also be a /vsimem/ path
+def CreateRasterMask(ds, raster_fn, vector_fn, burn_val = '', dtype = None, nbits = None, cache = True):
+    if dtype is None:
+        dtype = gdal.GDT_UInt16 if burn_val else gdal.GDT_Byte
+    mtime = os.path.getmtime(vector_fn) if os.path.exists(vector_fn) else None
+    #burned attribute values are stored in the .dbf, which can change without the .shp
+    dbf = os.path.splitext(vector_fn)[0] + '.dbf'
+    dbf_mtime = os.path.getmtime(dbf) if burn_val and os.path.exists(dbf) else None
+    key = (os.path.abspath(vector_fn), mtime, burn_val, dbf_mtime, dtype, ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize, ds.GetProjection())
+    mask_ds = mask_cache.pop(key, None) if cache else None
+    if mask_ds is not None:
+        mask_cache[key] = mask_ds
+
+    if mask_ds is None:
+        # Open vector file and get Layer
+        vec_ds = ogr.Open(vector_fn)
+        vec_layer = vec_ds.GetLayer()
+
+        # Get GeoTransform of Geotiff to be masked
+        geo = ds.GetGeoTransform()
+
+        # Create the mask (in memory)
+#####        mask_ds = gdal.GetDriverByName('GTiff').Create(raster_fn, ds.RasterXSize, ds.RasterYSize, 1, gdal.GDT_Byte)
+        mask_ds = gdal.GetDriverByName('MEM').Create('', ds.RasterXSize, ds.RasterYSize, 1, dtype)
+        mask_ds.SetGeoTransform((geo[0], geo[1], geo[2], geo[3], geo[4], geo[5]))
+        mask_ds.SetProjection(ds.GetProjection())
+        band = mask_ds.GetRasterBand(1)
+        #pixels outside the polygons are 0 (a -999 nodata value cannot be stored in an unsigned band)
+        if gdal.GetDataTypeName(dtype).startswith(('Int', 'Float')):
+            band.SetNoDataValue(-999)
+
+        # Rasterize (vector file is rasterized into the projection of the original dataset, ds)
+        #can also add options for including pixels that are partially within the polygon, rather than the default of only entire pixels
+        if not burn_val:
+            gdal.RasterizeLayer(mask_ds, [1], vec_layer, burn_values=[1])
+        else:
+            gdal.RasterizeLayer(mask_ds, [1], vec_layer, options = ["ATTRIBUTE="+burn_val])
+
+        band = None
+        vec_ds = None
+        if cache:
+            cache_mask(key, mask_ds)
+
+    if not raster_fn:
+        return mask_ds
+
+    # Write the mask geotiff
+    options = raster.creation_options(dtype)
+    if nbits is not None:
+        options = [option for option in options if not option.startswith('PREDICTOR=')] + ['NBITS=' + str(nbits)]
+    mask_array = gdal.GetDriverByName('GTiff').CreateCopy(raster_fn, mask_ds, 0, options)
+    return mask_array
+
+
+#adds a mask to mask_cache, dropping the least recently used masks while the cache holds more than MASK_CACHE_MB
+    #(the newest mask is always kept)
+def cache_mask(key, mask_ds):
+    mask_cache[key] = mask_ds
+    def size(m):
+        return m.RasterXSize * m.RasterYSize * (gdal.GetDataTypeSize(m.GetRasterBand(1).DataType) // 8)
+    total = sum(size(m) for m in mask_cache.values())
+    while total > MASK_CACHE_MB * 1024 * 1024 and len(mask_cache) > 1:
+        old_key, old_ds = mask_cache.popitem(last=False)
+        total -= size(old_ds)
+
+
+#returns the pixel window (xoff, yoff, xsize, ysize) of the input dataset (ds, north up) covering the extent
+    #of the layer in vector_fn (reprojected to the dataset's projection if needed), clipped to the dataset
+    #raises ValueError if the layer does not overlap the dataset
+def LayerWindow(ds, vector_fn):
     vec_ds = ogr.Open(vector_fn)
     vec_layer = vec_ds.GetLayer()
+    minx, maxx, miny, maxy = vec_layer.GetExtent()
+
+    # Reproject the corners of the extent if the layer is not in the projection of ds
+    vec_srs = vec_layer.GetSpatialRef()
+    ds_srs = osr.SpatialReference(wkt=ds.GetProjection())
+    if vec_srs is not None and ds.GetProjection() and not vec_srs.IsSame(ds_srs):
+        for srs in (vec_srs, ds_srs):
+            if hasattr(srs, 'SetAxisMappingStrategy'):
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(vec_srs, ds_srs)
+        corners = [transform.TransformPoint(x, y)[:2] for x in (minx, maxx) for y in (miny, maxy)]
+        minx = min(c[0] for c in corners)
+        maxx = max(c[0] for c in corners)
+        miny = min(c[1] for c in corners)
+        maxy = max(c[1] for c in corners)
+    vec_ds = None
 
-    # Get GeoTransform of Geotiff to be masked
     geo = ds.GetGeoTransform()
+    x0 = max(int(math.floor((minx - geo[0]) / geo[1])), 0)
+    x1 = min(int(math.ceil((maxx - geo[0]) / geo[1])), ds.RasterXSize)
+    y0 = max(int(math.floor((maxy - geo[3]) / geo[5])), 0)
+    y1 = min(int(math.ceil((miny - geo[3]) / geo[5])), ds.RasterYSize)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(vector_fn + ' does not overlap the raster')
+    return x0, y0, x1 - x0, y1 - y0
 
-    # Create the mask geotiff
-    print "check for correct output type (e.g. UInt16) for raster pixel values"
-#####    mask_ds = gdal.GetDriverByName('GTiff').Create(raster_fn, ds.RasterXSize, ds.RasterYSize, 1, gdal.GDT_Byte)
-    mask_array = gdal.GetDriverByName('GTiff').Create(raster_fn, ds.RasterXSize, ds.RasterYSize, 1, gdal.GDT_UInt16)
-    mask_array.SetGeoTransform((geo[0], geo[1], geo[2], geo[3], geo[4], geo[5]))
-    mask_array.SetProjection(ds.GetProjection())
-    band = mask_array.GetRasterBand(1)
-    band.SetNoDataValue(-999)
-
-    # Rasterize (vector file is rasterized into the projection of the original dataset, ds)
-    #can also add options for including pixels that are partially within the polygon, rather than the default of only entire pixels
-    if not burn_val:
-        gdal.RasterizeLayer(mask_array, [1], vec_layer, burn_values=[1])
-    else:
-        gdal.RasterizeLayer(mask_array, [1], vec_layer, options = ["ATTRIBUTE="+burn_val])
 
-    vec_ds = None
-    return mask_array
\ No newline at end of file
+#creates a raster mask (as CreateRasterMask, cached, in memory unless raster_fn is given) covering only the pixel window
+    #of the input dataset (ds) that contains the polygons of vector_fn (see LayerWindow), instead of the whole dataset
+    #returns (mask dataset, xoff, yoff): the mask covers pixels xoff to xoff + mask.RasterXSize (and yoff...) of ds (see ReadWindow)
+def CreateWindowMask(ds, vector_fn, burn_val = '', dtype = None, raster_fn = None, nbits = None, cache = True):
+    xoff, yoff, xsize, ysize = LayerWindow(ds, vector_fn)
+    geo = ds.GetGeoTransform()
+
+    # Empty (no band) dataset with the grid of the window, for CreateRasterMask
+    window_ds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 0)
+    window_ds.SetGeoTransform((geo[0] + xoff * geo[1] + yoff * geo[2], geo[1], geo[2],
+                               geo[3] + xoff * geo[4] + yoff * geo[5], geo[4], geo[5]))
+    window_ds.SetProjection(ds.GetProjection())
+
+    mask_ds = CreateRasterMask(window_ds, raster_fn, vector_fn, burn_val, dtype, nbits, cache)
+    window_ds = None
+    return mask_ds, xoff, yoff
+
+
+#reads the window of a band (of a dataset on the same grid as the one given to CreateWindowMask) matching a window mask
+def ReadWindow(band, mask_ds, xoff, yoff):
+    return band.ReadAsArray(xoff, yoff, mask_ds.RasterXSize, mask_ds.RasterYSize)
+
+
+#empties the cache of rasterized masks (e.g. at the end of a batch, to free the memory)
+def clear_mask_cache():
+    mask_cache.clear()
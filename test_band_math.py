@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+DESCRIPTION:
+checks that the classification expressions of band_math keep nodata pixels as CLASS_NODATA after thresholding
+
+SYNTAX:
+python -m unittest test_band_math
+"""
+
+import unittest
+
+try:
+    import numpy as np
+    import band_math
+except ImportError:
+    band_math = None
+
+
+@unittest.skipIf(band_math is None, 'numpy and GDAL are needed')
+class ClassNodataTest(unittest.TestCase):
+    def test_NDSI_zero_sum_is_nodata(self):
+        bandi = np.array([[0.5, 0.0, 0.1]], np.float32)
+        bandj = np.array([[0.1, 0.0, 0.5]], np.float32)
+        result = band_math.NDSI_EXPRESSION.apply({'bandi': bandi, 'bandj': bandj, 'threshold': 0.4},
+                                                 None, np.uint8, band_math.CLASS_NODATA)
+        self.assertEqual(result.tolist(), [[1, band_math.CLASS_NODATA, 0]])
+
+    def test_twob_avg_outside_mask_is_nodata(self):
+        bandi = np.array([[0.8, 0.8, 0.1]], np.float32)
+        bandj = np.array([[0.6, 0.6, 0.1]], np.float32)
+        mask = np.array([[1, 0, 1]], np.float32)
+        result = band_math.TWOB_AVG_EXPRESSION.apply({'bandi': bandi, 'bandj': bandj, 'mask': mask, 'threshold': 0.5},
+                                                     None, np.uint8, band_math.CLASS_NODATA)
+        self.assertEqual(result.tolist(), [[1, band_math.CLASS_NODATA, 0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+DESCRIPTION:
+checks that extract_values maps points on and around the raster edges to the pixel holding them
+
+SYNTAX:
+python -m unittest test_extract_values
+"""
+
+import unittest
+
+try:
+    import numpy as np
+    import extract_values
+except ImportError:
+    extract_values = None
+
+#30m pixels, 10 columns and 5 rows, upper left corner at (0, 150)
+GEOTRANSFORM = (0, 30, 0, 150, 0, -30)
+XSIZE = 10
+YSIZE = 5
+
+
+@unittest.skipIf(extract_values is None, 'numpy and GDAL are needed')
+class MapToPixelsTest(unittest.TestCase):
+    def inside(self, rX, rY):
+        return (rX >= 0) & (rX < XSIZE) & (rY >= 0) & (rY < YSIZE)
+
+    def test_points_inside(self):
+        mX = np.array([0.0, 20.0, 30.0, 295.0])
+        mY = np.array([150.0, 140.0, 1.0, 0.5])
+        rX, rY = extract_values.mapToPixels(mX, mY, GEOTRANSFORM)
+        self.assertEqual(rX.tolist(), [0, 0, 1, 9])
+        self.assertEqual(rY.tolist(), [0, 0, 4, 4])
+        self.assertTrue(self.inside(rX, rY).all())
+
+    def test_points_outside(self):
+        mX = np.array([-10.0, 300.0, 15.0, 15.0])
+        mY = np.array([75.0, 75.0, 160.0, -0.5])
+        rX, rY = extract_values.mapToPixels(mX, mY, GEOTRANSFORM)
+        self.assertFalse(self.inside(rX, rY).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+DESCRIPTION:
+zonal statistics of raster bands over the polygons of a shapefile (e.g. a glacier inventory): the polygons are
+rasterized once per grid as zone numbers, then every band is read once (window by window) and reduced for all
+polygons at the same time (np.bincount / np.minimum.reduceat) instead of looping over the polygons
+
+FUNCTIONS:
+    rasterize the polygons of a shapefile as zone numbers (1 to number of features, 0 outside), cached per grid (rasterize_zones, clear_zone_cache)
+    count/sum/mean/min/max/std (and optional histograms) of bands per polygon (zonal_stats)
+    write the statistics as a CSV table (write_table)
+
+SYNTAX:
+python full_path_to_script/zonal.py shapefile outfile.csv raster_files... [--tile MB] [--bins N] [--range min,max]
+    a raster file can be given as file.tif:band for a band other than 1 (e.g. of a Landsat_TOARefl reflectance stack)
+
+NOTES:
+every raster must be on the grid of the first one; nodata pixels (see raster.nodata_mask) are left out
+pixels are assigned to the polygon that GDAL burns last where polygons overlap
+"""
+
+import sys, os, csv
+from collections import OrderedDict
+from osgeo import gdal, ogr
+import numpy as np
+import raster
+import Landsat_TOARefl as toa
+
+#statistics columns of the table, in order
+STATS = ['count', 'sum', 'mean', 'min', 'max', 'std']
+
+#zone rasters already made, least recently used first, by (vector file, modification time, geotransform, size, projection)
+zone_cache = OrderedDict()
+#maximum size (megabytes) of the cached zone rasters (4 bytes per pixel); the least recently used ones are dropped beyond it
+ZONE_CACHE_MB = 512
+
+##########  Functions  ##########
+#rasterizes the polygons of vector_fn onto the grid of the input dataset (ds) as UInt32 zone numbers
+    #(feature i of the layer is zone i + 1, 0 is outside every polygon); cached per vector file and grid
+    #returns (in-memory zone dataset, array of the feature ids (FID) of zones 1..n)
+def rasterize_zones (ds, vector_fn, cache=True):
+    mtime = os.path.getmtime(vector_fn) if os.path.exists(vector_fn) else None
+    key = (os.path.abspath(vector_fn), mtime, ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize, ds.GetProjection())
+    if cache and key in zone_cache:
+        zones = zone_cache.pop(key)
+        zone_cache[key] = zones
+        return zones
+
+    vec_ds = ogr.Open(vector_fn)
+    vec_layer = vec_ds.GetLayer()
+
+    #copy the polygons to a memory layer with the zone number as an attribute to burn
+    mem_ds = ogr.GetDriverByName('Memory').CreateDataSource('zones')
+    mem_layer = mem_ds.CreateLayer('zones', vec_layer.GetSpatialRef(), vec_layer.GetGeomType())
+    mem_layer.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+    fids = []
+    vec_layer.ResetReading()
+    for feature in vec_layer:
+        zone = ogr.Feature(mem_layer.GetLayerDefn())
+        zone.SetGeometry(feature.GetGeometryRef())
+        zone.SetField('zone', len(fids) + 1)
+        mem_layer.CreateFeature(zone)
+        fids.append(feature.GetFID())
+
+    geo = ds.GetGeoTransform()
+    zones_ds = gdal.GetDriverByName('MEM').Create('', ds.RasterXSize, ds.RasterYSize, 1, gdal.GDT_UInt32)
+    zones_ds.SetGeoTransform((geo[0], geo[1], geo[2], geo[3], geo[4], geo[5]))
+    zones_ds.SetProjection(ds.GetProjection())
+    gdal.RasterizeLayer(zones_ds, [1], mem_layer, options=['ATTRIBUTE=zone'])
+
+    mem_ds = None
+    vec_ds = None
+    zones = (zones_ds, np.array(fids, np.int64))
+    if cache:
+        zone_cache[key] = zones
+        #drop the least recently used zone rasters beyond ZONE_CACHE_MB (the newest is always kept)
+        total = sum(z[0].RasterXSize * z[0].RasterYSize * 4 for z in zone_cache.values())
+        while total > ZONE_CACHE_MB * 1024 * 1024 and len(zone_cache) > 1:
+            old_key, old_zones = zone_cache.popitem(last=False)
+            total -= old_zones[0].RasterXSize * old_zones[0].RasterYSize * 4
+    return zones
+
+
+#empties the cache of zone rasters (e.g. at the end of a batch, to free the memory)
+def clear_zone_cache ():
+    zone_cache.clear()
+
+
+#computes the statistics (STATS) of each band over each polygon of vector_fn, reading every band once window by window
+    #infiles is a list of filenames or (filename, band number) tuples on the same grid
+    #bins (optional) also counts a histogram of bins bins over value_range (min, max) per polygon (values outside it go to the end bins)
+    #returns a list of dictionaries (one per band and polygon with at least one valid pixel): fid, band, the STATS
+    #and, with bins, hist (array of counts)
+def zonal_stats (infiles, vector_fn, tileMB=None, bins=None, value_range=None):
+    #every band is read with the windows and zones of the first one, so they must all be on its grid
+    first = raster.get_template(infiles[0])
+    for infile in infiles[1:]:
+        t = raster.get_template(infile)
+        if (t.xsize, t.ysize, t.geotransform, t.projection) != (first.xsize, first.ysize, first.geotransform, first.projection):
+            raise ValueError(str(infile) + ' is not on the grid of ' + str(infiles[0]))
+    first_open, first_band = raster.open_band(infiles[0])
+    zones_ds, fids = rasterize_zones(first_open, vector_fn)
+    zones_band = zones_ds.GetRasterBand(1)
+    first_open = None
+    n = len(fids) + 1
+    if bins is not None and value_range is None:
+        raise ValueError('value_range is needed to count histograms')
+
+    rows = []
+    for infile in infiles:
+        infile_open, band = raster.open_band(infile)
+        count = np.zeros(n, np.int64)
+        total = np.zeros(n, np.float64)
+        sumsq = np.zeros(n, np.float64)
+        zmin = np.full(n, np.inf)
+        zmax = np.full(n, -np.inf)
+        hist = np.zeros((n, bins), np.int64) if bins is not None else None
+
+        for xoff, yoff, xsize, ysize in raster.block_windows(band, tileMB):
+            zones = zones_band.ReadAsArray(xoff, yoff, xsize, ysize)
+            values = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            valid = (zones > 0)
+            is_nodata = raster.nodata_mask(band, values, xoff, yoff)
+            if is_nodata is not None:
+                valid &= ~is_nodata
+            zones = zones[valid].astype(np.intp)
+            if not len(zones):
+                continue
+            values = values[valid].astype(np.float64)
+
+            count += np.bincount(zones, minlength=n)
+            total += np.bincount(zones, weights=values, minlength=n)
+            sumsq += np.bincount(zones, weights=values * values, minlength=n)
+
+            #min/max: sort the pixels by zone and reduce each run of the same zone
+            order = np.argsort(zones, kind='mergesort')
+            zones = zones[order]
+            values = values[order]
+            starts = np.flatnonzero(np.concatenate(([True], zones[1:] != zones[:-1])))
+            ids = zones[starts]
+            zmin[ids] = np.minimum(zmin[ids], np.minimum.reduceat(values, starts))
+            zmax[ids] = np.maximum(zmax[ids], np.maximum.reduceat(values, starts))
+
+            if hist is not None:
+                b = ((values - value_range[0]) * (bins / float(value_range[1] - value_range[0]))).astype(np.intp)
+                np.clip(b, 0, bins - 1, out=b)
+                hist += np.bincount(zones * bins + b, minlength=n * bins).reshape(n, bins)
+
+        infile_open = None
+        name = infile if not isinstance(infile, tuple) else infile[0] + ':' + str(infile[1])
+        for zone in np.flatnonzero(count[1:]) + 1:
+            mean = total[zone] / count[zone]
+            row = {'fid': int(fids[zone - 1]), 'band': name, 'count': int(count[zone]), 'sum': total[zone], 'mean': mean,
+                   'min': zmin[zone], 'max': zmax[zone], 'std': np.sqrt(max(sumsq[zone] / count[zone] - mean * mean, 0))}
+            if hist is not None:
+                row['hist'] = hist[zone]
+            rows.append(row)
+
+    return rows
+
+
+#writes zonal_stats rows to a CSV file (columns: fid, band, the STATS and, with histograms, hist_0, hist_1...)
+def write_table (rows, outfile):
+    columns = ['fid', 'band'] + STATS
+    bins = len(rows[0]['hist']) if rows and 'hist' in rows[0] else 0
+    f = open(outfile, 'wb')
+    writer = csv.writer(f)
+    writer.writerow(columns + ['hist_' + str(i) for i in range(bins)])
+    for row in rows:
+        writer.writerow([row[column] for column in columns] + (list(row['hist']) if bins else []))
+    f.close()
+    return outfile
+
+
+#////////////////////////////////////MAIN LOOP///////////////////////////////////////
+if __name__ == "__main__":
+    args, options = toa.splitOptions(sys.argv)
+    infiles = []
+    for name in args[3:]:
+        if ':' in name and name.rsplit(':', 1)[1].isdigit():
+            name, band = name.rsplit(':', 1)
+            infiles.append((name, int(band)))
+        else:
+            infiles.append(name)
+    tileMB = float(options['tile']) if 'tile' in options else None
+    bins = int(options['bins']) if 'bins' in options else None
+    value_range = [float(v) for v in options['range'].split(',')] if 'range' in options else None
+
+    rows = zonal_stats(infiles, args[1], tileMB, bins, value_range)
+    write_table(rows, args[2])
+    print str(len(rows)) + ' zone statistics written to ' + args[2]